@@ -1,59 +1,483 @@
 import os
 import uuid
+import asyncio
+import logging
+import logging.handlers
+import wave
 import time
 import threading
+import queue
+import tempfile
+import json
+import re
+import hashlib
+import math
+import shutil
+import gzip
+import subprocess
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from flask import Flask, request, jsonify, render_template_string, send_file, abort, render_template
-from pydub import AudioSegment
+from flask import Flask, request, jsonify, abort, render_template, Response
 import io
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from limits import parse as parse_rate_limit
 from werkzeug.utils import secure_filename
 import io
-import openai # Importa a biblioteca OpenAI
-import google.generativeai as genai # Importa a biblioteca Google Generative AI
+# openai, google.generativeai e pydub são importados na primeira vez que são usados:
+# importá-los aqui deixaria a inicialização de cada processo segundos mais lenta
 from dotenv import load_dotenv # Para carregar variáveis de ambiente do .env
+try:
+    import brotli # Opcional: habilita a variante 'br' dos resultados
+except ImportError:
+    brotli = None
+from storage import create_state_store
+from metrics import Counter, Gauge, Histogram, Registry
+from resilience import CircuitBreaker, CircuitOpenError, ResilientCaller
 
 # --- Configuração Inicial ---
 load_dotenv() # Carrega variáveis do arquivo .env
 
+
+# --- Logging ---
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Formata cada registro como uma linha JSON, incluindo os campos passados em 'extra'."""
+
+    _RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in self._RESERVED})
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging():
+    """Configura logs estruturados e não bloqueantes.
+
+    Quem loga apenas coloca o registro numa fila; uma thread dedicada
+    (QueueListener) faz a escrita no console. A thread só é iniciada em
+    start_background_services; até lá, os registros aguardam na fila.
+    """
+    log_queue = queue.SimpleQueue()
+    console = logging.StreamHandler()
+    console.setFormatter(JsonLogFormatter())
+    listener = logging.handlers.QueueListener(log_queue, console)
+    app_logger = logging.getLogger("braindump")
+    app_logger.setLevel(LOG_LEVEL)
+    app_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    app_logger.propagate = False
+    return app_logger, listener
+
+
+logger, log_listener = configure_logging()
+
 app = Flask(__name__)
 
+# Backend do estado (tarefas/resultados): 'memory' (um único processo), 'sqlite' ou 'redis'.
+# Com mais de um worker (gunicorn/uWSGI), use 'sqlite' ou 'redis' para compartilhar o estado.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+STATE_SQLITE_PATH = os.getenv("STATE_SQLITE_PATH", os.path.join(tempfile.gettempdir(), "braindump_state.db"))
+STATE_REDIS_URL = os.getenv("STATE_REDIS_URL", "redis://localhost:6379/0")
+# O Limiter também precisa de um armazenamento compartilhado entre processos (ex: redis://, memcached://)
+RATELIMIT_STORAGE_URI = os.getenv("RATELIMIT_STORAGE_URI", STATE_REDIS_URL if STATE_BACKEND == "redis" else "memory://")
+
 # Configuração do Limiter
 limiter = Limiter(
     get_remote_address,
     app=app,
     default_limits=["50 per day", "10 per hour"],
-    storage_uri="memory://",
+    storage_uri=RATELIMIT_STORAGE_URI,
     strategy="fixed-window"
 )
 
+# Orçamento de admissão em segundos de áudio, cobrado no mesmo armazenamento do Limiter.
+# O custo de cada upload é a duração do áudio; vazio desativa o orçamento.
+AUDIO_BUDGET_PER_CLIENT = os.getenv("AUDIO_BUDGET_PER_CLIENT", "7200 per hour") # Por IP
+AUDIO_BUDGET_GLOBAL = os.getenv("AUDIO_BUDGET_GLOBAL", "72000 per hour") # Todos os clientes
+audio_budget_per_client = parse_rate_limit(AUDIO_BUDGET_PER_CLIENT) if AUDIO_BUDGET_PER_CLIENT else None
+audio_budget_global = parse_rate_limit(AUDIO_BUDGET_GLOBAL) if AUDIO_BUDGET_GLOBAL else None
+ASSUMED_BITRATE_KBPS = int(os.getenv("ASSUMED_BITRATE_KBPS", 128)) # Estimativa da duração quando não é possível lê-la do arquivo
+# Gravações Opus do navegador (webm/ogg) costumam ter bitrate bem menor: uma taxa baixa evita subestimar a duração
+ASSUMED_OPUS_BITRATE_KBPS = int(os.getenv("ASSUMED_OPUS_BITRATE_KBPS", 24))
+OPUS_EXTENSIONS = {'.webm', '.ogg', '.opus'}
+# O teste e o consumo do orçamento são serializados neste processo; com vários workers,
+# uploads simultâneos em processos diferentes ainda podem ultrapassá-lo um pouco
+audio_budget_lock = threading.Lock()
+
 # Configurações da Aplicação
 ALLOWED_EXTENSIONS = {'wav', 'mp3'}
-MAX_CONTENT_LENGTH = 25 * 1024 * 1024  # 25 MB
+# Gravações do navegador são guardadas no formato original (a conversão fica para o worker)
+RECORDING_EXTENSIONS = {'audio/webm': '.webm', 'audio/ogg': '.ogg', 'audio/mp4': '.m4a', 'audio/mpeg': '.mp3',
+                        'audio/wav': '.wav', 'audio/x-wav': '.wav'}
+WHISPER_MAX_BYTES = 25 * 1024 * 1024  # 25 MB, limite de arquivo da API Whisper
 RESULT_EXPIRATION_MINUTES = 5
+# Resultados são guardados já codificados em UTF-8 e, opcionalmente, comprimidos ('gzip', 'br')
+RESULT_ENCODINGS = [encoding.strip() for encoding in os.getenv("RESULT_ENCODINGS", "gzip").lower().split(",")
+                    if encoding.strip() and encoding.strip() != "none"]
+RESULT_COMPRESS_MIN_BYTES = 1024 # Resultados menores não compensam a compressão
+RESULT_MEMORY_MAX_MB = int(os.getenv("RESULT_MEMORY_MAX_MB", 64)) # Memória máxima dos resultados (backend em memória)
+
+# Transcrição em partes: divide áudios longos em trechos transcritos em paralelo
+CHUNKED_TRANSCRIPTION = os.getenv("CHUNKED_TRANSCRIPTION", "false").lower() == "true"
+CHUNK_TARGET_SECONDS = int(os.getenv("CHUNK_TARGET_SECONDS", 120)) # Duração alvo de cada trecho
+CHUNK_OVERLAP_SECONDS = float(os.getenv("CHUNK_OVERLAP_SECONDS", 1.5)) # Sobreposição entre trechos vizinhos
+CHUNK_CONCURRENCY = int(os.getenv("CHUNK_CONCURRENCY", 4)) # Trechos transcritos simultaneamente (global)
+
+# Pré-processamento no worker, antes do Whisper: mono, 16 kHz, silêncios cortados e MP3 de baixa taxa
+AUDIO_PREPROCESSING = os.getenv("AUDIO_PREPROCESSING", "true").lower() == "true"
+PREPROCESS_SAMPLE_RATE = int(os.getenv("PREPROCESS_SAMPLE_RATE", 16000)) # Taxa usada pelo próprio Whisper
+PREPROCESS_BITRATE = os.getenv("PREPROCESS_BITRATE", "32k") # Suficiente para voz em mono a 16 kHz
+SILENCE_MAX_SECONDS = float(os.getenv("SILENCE_MAX_SECONDS", 1.0)) # Silêncios internos maiores são encurtados
+SILENCE_THRESHOLD_DB = float(os.getenv("SILENCE_THRESHOLD_DB", -40)) # Abaixo deste nível, o áudio conta como silêncio
+SILENCE_PADDING_MS = 200 # Silêncio mantido no início do áudio
+
+# Análise em partes (map-reduce) para transcrições longas: os segmentos são analisados
+# em paralelo e uma chamada final junta as análises no relatório
+LONG_TRANSCRIPT_CHARS = int(os.getenv("LONG_TRANSCRIPT_CHARS", 60000)) # A partir deste tamanho, usa map-reduce
+ANALYSIS_SEGMENT_CHARS = int(os.getenv("ANALYSIS_SEGMENT_CHARS", 15000)) # Tamanho máximo de cada segmento
+ANALYSIS_MAP_CONCURRENCY = int(os.getenv("ANALYSIS_MAP_CONCURRENCY", 8)) # Segmentos analisados simultaneamente (global)
+# Orçamento de tokens de entrada por chamada ao Gemini: prompts maiores são analisados em partes ou encurtados
+GEMINI_MAX_INPUT_TOKENS = int(os.getenv("GEMINI_MAX_INPUT_TOKENS", 32000))
+CHARS_PER_TOKEN_ESTIMATE = 4 # Estimativa local; a contagem do modelo só é consultada perto do limite
+
+# Cache de transcrições e análises (opcional), indexado pelo hash do conteúdo
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "false").lower() == "true"
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", 32)) # Memória máxima por camada de cache
+# O cache nunca guarda dados além da janela de privacidade dos resultados
+RESULT_CACHE_TTL_MINUTES = min(float(os.getenv("RESULT_CACHE_TTL_MINUTES", RESULT_EXPIRATION_MINUTES)),
+                               RESULT_EXPIRATION_MINUTES)
+
+# Sem a transcrição em partes, o upload fica limitado ao tamanho aceito pelo Whisper
+MAX_CONTENT_LENGTH = int(os.getenv("MAX_UPLOAD_MB", 200 if CHUNKED_TRANSCRIPTION else 25)) * 1024 * 1024
+
+# Configurações do pool de processamento
+# 'threads': uma thread por tarefa em andamento; 'asyncio': todas as tarefas num único event loop
+PROCESSING_ENGINE = os.getenv("PROCESSING_ENGINE", "threads").lower()
+ASYNC_ENGINE = PROCESSING_ENGINE == "asyncio"
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", 4)) # Número fixo de threads de processamento
+ASYNC_MAX_TASKS = int(os.getenv("ASYNC_MAX_TASKS", 200)) # Tarefas simultâneas no motor assíncrono
+MAX_QUEUED_TASKS = int(os.getenv("MAX_QUEUED_TASKS", 20)) # Tamanho máximo da fila de admissão
+# No motor assíncrono, uma chamada em espera não ocupa uma thread, então os limites padrão são maiores
+WHISPER_CONCURRENCY = int(os.getenv("WHISPER_CONCURRENCY", 64 if ASYNC_ENGINE else 2)) # Chamadas simultâneas ao Whisper
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", 64 if ASYNC_ENGINE else 2)) # Chamadas simultâneas ao Gemini
+
+# Uploads são gravados em arquivos temporários privados (0600) em vez de ficarem na memória
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "braindump_uploads"))
+SPOOL_MAX_AGE_SECONDS = 3600 # Arquivos órfãos (ex: tarefa perdida num restart) são apagados após 1 hora
+
+# Lotes: número máximo de arquivos por requisição em /batch (limitado pela fila de admissão)
+MAX_BATCH_FILES = min(int(os.getenv("MAX_BATCH_FILES", 10)), MAX_QUEUED_TASKS)
+
+# Server-Sent Events: intervalo (s) entre comentários de keep-alive e, a cada um, revalidação do status
+SSE_KEEPALIVE_SECONDS = int(os.getenv("SSE_KEEPALIVE_SECONDS", 15))
+
+# Long-poll em /status/<task_id>?wait=N: espera máxima (s) por uma mudança de estado
+STATUS_MAX_WAIT_SECONDS = int(os.getenv("STATUS_MAX_WAIT_SECONDS", 30))
+
+# Clientes das APIs: criados uma vez por processo e reaproveitados entre as tarefas
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+API_TIMEOUT_SECONDS = float(os.getenv("API_TIMEOUT_SECONDS", 300)) # Tempo máximo de cada chamada às APIs
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 20)) # Conexões simultâneas com a OpenAI
+HTTP_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_KEEPALIVE_CONNECTIONS", 10)) # Conexões ociosas mantidas abertas
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("HTTP_KEEPALIVE_SECONDS", 60)) # Tempo que uma conexão ociosa fica aberta
+API_WARMUP = os.getenv("API_WARMUP", "false").lower() == "true" # Abre as conexões com as APIs na inicialização
+
+# Resiliência das chamadas às APIs: prazo total por estágio (somando as tentativas e as partes; cada tentativa
+# usa no máximo API_TIMEOUT_SECONDS), novas tentativas com backoff e jitter, hedging e circuit breaker
+WHISPER_DEADLINE_SECONDS = float(os.getenv("WHISPER_DEADLINE_SECONDS", 600))
+GEMINI_DEADLINE_SECONDS = float(os.getenv("GEMINI_DEADLINE_SECONDS", 600))
+API_MAX_ATTEMPTS = int(os.getenv("API_MAX_ATTEMPTS", 3)) # Tentativas por chamada, incluindo a primeira
+API_RETRY_BASE_SECONDS = float(os.getenv("API_RETRY_BASE_SECONDS", 1)) # Espera base antes da 2ª tentativa
+API_RETRY_MAX_SECONDS = float(os.getenv("API_RETRY_MAX_SECONDS", 20)) # Espera máxima entre tentativas
+API_HEDGING = os.getenv("API_HEDGING", "false").lower() == "true" # Duplica chamadas lentas
+API_HEDGE_QUANTILE = float(os.getenv("API_HEDGE_QUANTILE", 0.95)) # Percentil de latência que dispara a cópia
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5)) # Falhas seguidas que abrem o circuito
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", 30)) # Tempo com o circuito aberto
 
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 
 # Configuração das APIs
-openai.api_key = os.getenv("OPENAI_API_KEY")
-google_api_key = os.getenv("GOOGLE_API_KEY")
+openai_api_key = os.getenv("OPENAI_API_KEY")
+google_api_key = os.getenv("GOOGLE_API_KEY") # O SDK do Gemini é configurado ao criar o primeiro modelo
 
-if not openai.api_key:
-    print("AVISO: Chave da API OpenAI não encontrada nas variáveis de ambiente (OPENAI_API_KEY). A transcrição falhará.")
+if not openai_api_key:
+    logger.warning("AVISO: Chave da API OpenAI não encontrada nas variáveis de ambiente (OPENAI_API_KEY). A transcrição falhará.")
 if not google_api_key:
-    print("AVISO: Chave da API Google não encontrada nas variáveis de ambiente (GOOGLE_API_KEY). A análise LLM falhará.")
-else:
-    try:
-        genai.configure(api_key=google_api_key)
-    except Exception as e:
-        print(f"Erro ao configurar a API Google Generative AI: {e}")
+    logger.warning("AVISO: Chave da API Google não encontrada nas variáveis de ambiente (GOOGLE_API_KEY). A análise LLM falhará.")
+
+
+# --- Métricas (Prometheus) ---
+metrics_registry = Registry()
+LATENCY_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+QUEUE_WAIT_SECONDS = metrics_registry.register(Histogram(
+    'braindump_queue_wait_seconds', 'Tempo entre o enfileiramento e o início da tarefa.', LATENCY_BUCKETS))
+WHISPER_SECONDS = metrics_registry.register(Histogram(
+    'braindump_whisper_seconds', 'Latência da transcrição (Whisper), sem a espera por vaga.', LATENCY_BUCKETS))
+GEMINI_SECONDS = metrics_registry.register(Histogram(
+    'braindump_gemini_seconds', 'Latência da análise (Gemini), sem a espera por vaga.', LATENCY_BUCKETS))
+TASK_SECONDS = metrics_registry.register(Histogram(
+    'braindump_task_seconds', 'Tempo total de processamento de uma tarefa.', LATENCY_BUCKETS))
+UPLOAD_BYTES = metrics_registry.register(Histogram(
+    'braindump_upload_bytes', 'Tamanho dos arquivos de áudio recebidos.',
+    tuple(mb * 1024 * 1024 for mb in (0.5, 1, 2, 5, 10, 25, 50, 100, 200))))
+AUDIO_DURATION_SECONDS = metrics_registry.register(Histogram(
+    'braindump_audio_duration_seconds', 'Duração dos áudios processados.', (30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)))
+STATE_LOCK_WAIT_SECONDS = metrics_registry.register(Histogram(
+    'braindump_state_lock_wait_seconds', 'Espera pelo lock do estado em memória.',
+    (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)))
+PREPROCESS_SECONDS = metrics_registry.register(Histogram(
+    'braindump_preprocess_seconds', 'Duração do pré-processamento do áudio.', LATENCY_BUCKETS))
+PREPROCESS_SAVED_BYTES = metrics_registry.register(Counter(
+    'braindump_preprocess_saved_bytes_total', 'Bytes a menos enviados ao Whisper pelo pré-processamento.'))
+PREPROCESS_SAVED_SECONDS = metrics_registry.register(Counter(
+    'braindump_preprocess_saved_audio_seconds_total', 'Segundos de silêncio removidos antes da transcrição.'))
+API_ERRORS = metrics_registry.register(Counter(
+    'braindump_api_errors_total', 'Erros nas chamadas às APIs externas.', ('api',)))
+TASKS_FINISHED = metrics_registry.register(Counter(
+    'braindump_tasks_total', 'Tarefas finalizadas, por status.', ('status',)))
+API_RESILIENCE_EVENTS = metrics_registry.register(Counter(
+    'braindump_api_resilience_events_total', 'Novas tentativas, requisições duplicadas e aberturas de circuito, por API.',
+    ('api', 'event')))
+
+
+# --- Armazenamento do Estado ---
+# Tarefas e resultados ficam no backend configurado (ver storage.py)
+state_store = create_state_store(STATE_BACKEND, sqlite_path=STATE_SQLITE_PATH, redis_url=STATE_REDIS_URL,
+                                 lock_wait_observer=STATE_LOCK_WAIT_SECONDS.observe,
+                                 max_result_bytes=RESULT_MEMORY_MAX_MB * 1024 * 1024)
+if 'br' in RESULT_ENCODINGS and brotli is None:
+    logger.warning("AVISO: RESULT_ENCODINGS inclui 'br', mas o pacote 'brotli' não está instalado. Usando apenas gzip.")
+    RESULT_ENCODINGS = [encoding for encoding in RESULT_ENCODINGS if encoding != 'br'] or ['gzip']
+if STATE_BACKEND != 'memory' and RATELIMIT_STORAGE_URI == 'memory://':
+    logger.warning("AVISO: O estado é compartilhado, mas o Limiter usa memória local. Configure RATELIMIT_STORAGE_URI.")
+CACHE_PURGE_INTERVAL_SECONDS = 60 # Intervalo entre limpezas dos caches
+
+
+# --- Cache de Resultados ---
+class ResultCache:
+    """Cache LRU com expiração (TTL) e limite de memória para textos.
+
+    As chaves são hashes do conteúdo de entrada (bytes do áudio ou texto da
+    transcrição), de modo que reenvios do mesmo arquivo reaproveitam o
+    trabalho já feito sem novas chamadas às APIs. Com lookup(), envios
+    simultâneos do mesmo conteúdo esperam o cálculo já em andamento em vez
+    de repeti-lo (apenas dentro deste processo).
+    """
+
+    def __init__(self, name, ttl_seconds, max_bytes):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # chave -> (valor, tamanho, expira_em)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._in_flight = {} # chave -> Future do cálculo em andamento
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+
+    def get(self, key):
+        """Retorna o valor em cache (ou None), contabilizando acerto/falha."""
+        with self._lock:
+            return self._get_locked(key)
+
+    def _get_locked(self, key):
+        entry = self._entries.get(key)
+        if entry and entry[2] > time.monotonic():
+            self._entries.move_to_end(key) # Marca como usado recentemente
+            self.hits += 1
+            return entry[0]
+        if entry:
+            self._remove(key)
+        self.misses += 1
+        return None
+
+    def lookup(self, key):
+        """Consulta o cache coalescendo cálculos simultâneos da mesma chave.
+
+        Retorna (valor, None) num acerto; (None, future) se outra tarefa já calcula
+        o valor, que chega pelo future (None se ela falhar); ou (None, None) se quem
+        chamou deve calcular o valor e depois chamar put() ou abandon().
+        """
+        with self._lock:
+            pending = self._in_flight.get(key)
+            if pending is not None:
+                self.coalesced += 1
+                return None, pending
+            value = self._get_locked(key)
+            if value is None:
+                self._in_flight[key] = Future()
+            return value, None
+
+    def abandon(self, key):
+        """Desiste de calcular o valor reservado por lookup(); quem esperava calcula o seu."""
+        with self._lock:
+            pending = self._in_flight.pop(key, None)
+        if pending is not None:
+            pending.set_result(None)
+
+    def put(self, key, value):
+        """Armazena um valor, removendo entradas antigas se exceder a memória."""
+        with self._lock:
+            pending = self._in_flight.pop(key, None)
+        if pending is not None:
+            pending.set_result(value)
+        size = len(value.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic() + self.ttl_seconds)
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def purge_expired(self):
+        """Remove as entradas expiradas (chamado pela limpeza periódica)."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, entry in self._entries.items() if entry[2] <= now]
+            for key in expired:
+                self._remove(key)
+        return len(expired)
+
+    def stats(self):
+        """Contadores de uso do cache."""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'coalesced': self.coalesced, # Envios que esperaram um cálculo idêntico em andamento
+                'in_flight': len(self._in_flight),
+            }
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._total_bytes -= size
+
+
+def content_hash(data):
+    """Hash SHA-256 usado como chave dos caches (aceita bytes ou str)."""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_content_hash(path, block_size=1024 * 1024):
+    """Hash SHA-256 de um arquivo, lido em blocos para não carregá-lo inteiro na memória."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def wait_cached(cache, key, on_wait):
+    """Valor em cache para key, esperando um cálculo idêntico em andamento.
+
+    Retorna None se quem chamou deve calcular o valor (e então chamar cache.put ou
+    cache.abandon). on_wait() é chamado antes de cada espera.
+    """
+    if not key:
+        return None
+    while True:
+        value, pending = cache.lookup(key)
+        if pending is None:
+            return value
+        on_wait()
+        value = pending.result()
+        if value is not None:
+            return value
+        # Quem calculava falhou: consulta de novo (e talvez assuma o cálculo)
+
+
+async def wait_cached_async(cache, key, on_wait):
+    """Versão assíncrona de wait_cached: nem on_wait() nem a espera bloqueiam o event loop."""
+    if not key:
+        return None
+    while True:
+        value, pending = cache.lookup(key)
+        if pending is None:
+            return value
+        await asyncio.to_thread(on_wait)
+        value = await asyncio.wrap_future(pending)
+        if value is not None:
+            return value
+
+
+# Camada 1: hash do áudio -> transcrição; camada 2: hash da transcrição -> análise
+transcript_cache = ResultCache('transcripts', RESULT_CACHE_TTL_MINUTES * 60, RESULT_CACHE_MAX_MB * 1024 * 1024)
+analysis_cache = ResultCache('analyses', RESULT_CACHE_TTL_MINUTES * 60, RESULT_CACHE_MAX_MB * 1024 * 1024)
+
+
+# --- Eventos de Progresso (Server-Sent Events) ---
+class TaskEventBroker:
+    """Distribui eventos de uma tarefa para os clientes conectados em /events.
+
+    Cada assinante recebe uma fila própria. O texto parcial da análise é
+    acumulado para que um cliente que conecte no meio do streaming receba
+    o que já foi gerado.
+    """
+
+    def __init__(self, max_pending_events=1000):
+        self.max_pending_events = max_pending_events
+        self._subscribers = {} # task_id -> lista de filas
+        self._partial_analysis = {} # task_id -> lista de fragmentos já gerados
+        self._lock = threading.Lock()
+
+    def subscribe(self, task_id):
+        """Registra um assinante. Retorna (fila, texto parcial já gerado)."""
+        events = queue.Queue(maxsize=self.max_pending_events)
+        with self._lock:
+            self._subscribers.setdefault(task_id, []).append(events)
+            partial = "".join(self._partial_analysis.get(task_id, []))
+        return events, partial
+
+    def unsubscribe(self, task_id, events):
+        with self._lock:
+            subscribers = self._subscribers.get(task_id, [])
+            if events in subscribers:
+                subscribers.remove(events)
+            if not subscribers:
+                self._subscribers.pop(task_id, None)
+
+    def publish(self, task_id, event, data=None):
+        """Envia um evento para todos os assinantes da tarefa (sem bloquear)."""
+        with self._lock:
+            if event == 'analysis':
+                self._partial_analysis.setdefault(task_id, []).append(data['text'])
+            elif event == 'analysis_reset': # Nova tentativa da análise: o texto recomeça
+                self._partial_analysis.pop(task_id, None)
+            elif event == 'status' and data and data.get('status') in ('completed', 'failed', 'expired'):
+                self._partial_analysis.pop(task_id, None)
+            subscribers = list(self._subscribers.get(task_id, []))
+        for events in subscribers:
+            try:
+                events.put_nowait((event, data))
+            except queue.Full:
+                # Cliente lento: descarta o evento; o status é revalidado no keep-alive
+                pass
 
 
-# --- Armazenamento em Memória ---
-tasks = {}
-results = {}
-data_lock = threading.Lock()
+task_events = TaskEventBroker()
 
 # --- Funções Auxiliares (allowed_file, get_task_status, update_task_status, store_result, get_result, cleanup_expired_data) ---
 # (O código destas funções permanece o mesmo da versão anterior - omitido por brevidade, mas deve estar aqui)
@@ -65,250 +489,1554 @@ def allowed_file(filename):
 
 def get_task_status(task_id):
     """Obtém o status de uma tarefa de forma segura."""
-    with data_lock:
-        # Retorna uma cópia para evitar modificações externas inesperadas
-        task_data = tasks.get(task_id)
-        return task_data.copy() if task_data else None
-
-
-def update_task_status(task_id, status, message=None, error=None, result_id=None):
-    """Atualiza o status de uma tarefa de forma segura."""
-    with data_lock:
-        if task_id in tasks:
-            task = tasks[task_id]
-            task['status'] = status
-            if message is not None: # Permite limpar a mensagem passando None
-                task['message'] = message
-            if error is not None: # Permite limpar o erro passando None
-                task['error'] = error
-            if result_id is not None:
-                task['result_id'] = result_id
-            if status in ['completed', 'failed']:
-                # Define o tempo de expiração do status da tarefa também (ex: 1 hora após conclusão/falha)
-                task['expires_at'] = datetime.now(timezone.utc) + timedelta(hours=1)
-            print(f"Task {task_id} updated: Status={status}, Message={message}, Error={error}") # Log de atualização
-        else:
-            print(f"Warning: Attempted to update non-existent task {task_id}")
+    # O backend retorna uma cópia para evitar modificações externas inesperadas
+    return state_store.get_task(task_id)
+
+
+def update_task_status(task_id, status, message=None, error=None, result_id=None, extra=None):
+    """Atualiza o status de uma tarefa de forma segura e notifica os clientes SSE."""
+    fields = dict(extra or {}, status=status)
+    if message is not None: # Permite limpar a mensagem passando None
+        fields['message'] = message
+    if error is not None: # Permite limpar o erro passando None
+        fields['error'] = error
+    if result_id is not None:
+        fields['result_id'] = result_id
+    expires_at = None
+    if status in ['completed', 'failed']:
+        # Define o tempo de expiração do status da tarefa também (ex: 1 hora após conclusão/falha)
+        expires_at = datetime.now(timezone.utc) + timedelta(hours=1)
+
+    if state_store.update_task(task_id, fields, expires_at=expires_at):
+        logger.info(f"Task {task_id} updated: Status={status}", # Log de atualização
+                    extra={'task_id': task_id, 'status': status, 'detail': message, 'error': error})
+        task_events.publish(task_id, 'status', {'status': status})
+    else:
+        logger.warning(f"Warning: Attempted to update non-existent task {task_id}", extra={'task_id': task_id})
+
+
+def compress_result(data, encoding):
+    """Comprime o conteúdo de um resultado ('gzip' ou 'br')."""
+    if encoding == 'br':
+        return brotli.compress(data, mode=brotli.MODE_TEXT)
+    # mtime fixo: o mesmo conteúdo gera sempre os mesmos bytes
+    return gzip.compress(data, compresslevel=6, mtime=0)
 
 
 def store_result(result_id, content, filename):
-    """Armazena o resultado Markdown de forma segura."""
-    with data_lock:
-        results[result_id] = {
-            'content': content,
-            'filename': filename,
-            'created_at': datetime.now(timezone.utc)
-        }
-        print(f"Result {result_id} stored.")
+    """Armazena o resultado Markdown de forma segura.
+
+    O texto é codificado (e comprimido) uma única vez aqui, e não a cada download.
+    """
+    created_at = datetime.now(timezone.utc)
+    data = content.encode('utf-8')
+    result = {
+        'content': data,
+        'etag': content_hash(data)[:32],
+        'filename': filename,
+        'created_at': created_at
+    }
+    if len(data) >= RESULT_COMPRESS_MIN_BYTES:
+        for encoding in RESULT_ENCODINGS:
+            compressed = compress_result(data, encoding)
+            if len(compressed) < len(data):
+                result[encoding] = compressed
+    state_store.store_result(result_id, result, expires_at=created_at + timedelta(minutes=RESULT_EXPIRATION_MINUTES))
+    logger.info(f"Result {result_id} stored.", extra={'result_id': result_id})
 
 
 def get_result(result_id):
     """Obtém um resultado e verifica a expiração."""
-    with data_lock:
-        result_data = results.get(result_id)
-        if result_data:
-            expiration_time = result_data['created_at'] + timedelta(minutes=RESULT_EXPIRATION_MINUTES)
-            if datetime.now(timezone.utc) < expiration_time:
-                # Retorna uma cópia
-                return result_data.copy()
-            else:
-                # Resultado expirado, remove
-                print(f"Result {result_id} expired. Removing.")
-                del results[result_id]
-                # Tenta remover a tarefa associada se ainda existir e não estiver processando
-                task_to_remove = None
-                for task_id, task_info in tasks.items():
-                    if task_info.get('result_id') == result_id and task_info.get('status') != 'processing':
-                        task_to_remove = task_id
-                        break
-                if task_to_remove:
-                    print(f"Removing associated task {task_to_remove} for expired result {result_id}.")
-                    del tasks[task_to_remove]
-                return None
+    # O backend descarta resultados vencidos (e, quando possível, a tarefa associada)
+    return state_store.get_result(result_id)
+
+
+def create_spool_file(suffix):
+    """Cria um arquivo temporário privado para um upload. Retorna (fd, caminho)."""
+    os.makedirs(UPLOAD_SPOOL_DIR, mode=0o700, exist_ok=True)
+    # mkstemp cria o arquivo com permissão 0600 (somente o dono lê/escreve)
+    return tempfile.mkstemp(prefix="upload_", suffix=suffix, dir=UPLOAD_SPOOL_DIR)
+
+
+def discard_spool_file(path):
+    """Apaga o arquivo temporário de um upload (ignora se já foi apagado)."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.error(f"Erro ao apagar arquivo temporário {path}: {e}")
+
+
+def probe_audio_duration(path):
+    """Duração do áudio em segundos, sem decodificá-lo (None se não for possível obtê-la)."""
+    if path.lower().endswith('.wav'):
+        # WAV PCM: a duração vem do cabeçalho. O módulo wave não lê WAV em ponto
+        # flutuante nem WAVE_FORMAT_EXTENSIBLE; esses seguem para o ffprobe
+        try:
+            with wave.open(path, 'rb') as wav_file:
+                return wav_file.getnframes() / float(wav_file.getframerate())
+        except Exception:
+            pass
+    try:
+        from pydub.utils import mediainfo
+        # Demais formatos: lê os metadados com ffprobe
+        return float(mediainfo(path)['duration'])
+    except Exception:
+        pass
+    try:
+        return demux_audio_duration(path)
+    except Exception:
         return None
 
 
-def cleanup_expired_data():
-    """Remove tarefas e resultados expirados periodicamente."""
+def demux_audio_duration(path):
+    """Duração obtida lendo os pacotes de áudio sem decodificá-los (None se não houver áudio).
+
+    Gravações webm/opus do navegador costumam não trazer a duração nos metadados.
+    """
+    output = run_ffmpeg(["-i", path, "-map", "0:a:0", "-c", "copy", "-f", "null", "-progress", "pipe:1", "-"])
+    times = re.findall(rb"out_time_us=(\d+)", output)
+    return int(times[-1]) / 1_000_000 if times and int(times[-1]) > 0 else None
+
+
+def estimate_audio_seconds(path, duration=None):
+    """Duração do áudio para o orçamento de admissão.
+
+    Usa a duração informada ou o cabeçalho/metadados do arquivo (ou os pacotes de
+    áudio) e, se não for possível lê-los, estima pelo tamanho com ASSUMED_BITRATE_KBPS
+    (ou com ASSUMED_OPUS_BITRATE_KBPS nos formatos do navegador).
+    """
+    if duration is None:
+        duration = probe_audio_duration(path)
+    if duration is None:
+        is_opus = os.path.splitext(path)[1].lower() in OPUS_EXTENSIONS
+        bitrate_kbps = ASSUMED_OPUS_BITRATE_KBPS if is_opus else ASSUMED_BITRATE_KBPS
+        duration = os.path.getsize(path) * 8 / (bitrate_kbps * 1000)
+    return duration
+
+
+def measure_upload(path, original_filename):
+    """Duração do upload para o orçamento, ou (None, resposta de recusa).
+
+    Arquivos acima do limite do Whisper só podem ser transcritos divididos em trechos,
+    o que exige ler a duração: sem ela, são recusados já no upload.
+    """
+    duration = probe_audio_duration(path)
+    if duration is None and os.path.getsize(path) > WHISPER_MAX_BYTES:
+        return None, (jsonify({"detail": f"Não foi possível ler a duração de '{original_filename}', necessária para "
+                                         f"dividir arquivos maiores que {WHISPER_MAX_BYTES // (1024*1024)}MB. "
+                                         "Converta-o para MP3 ou WAV e tente novamente."}), 415)
+    return estimate_audio_seconds(path, duration), None
+
+
+def purge_orphan_spool_files(max_age_seconds=SPOOL_MAX_AGE_SECONDS):
+    """Apaga arquivos de upload antigos que nenhuma tarefa removeu."""
+    if not os.path.isdir(UPLOAD_SPOOL_DIR):
+        return 0
+    cutoff = time.time() - max_age_seconds
+    removed = 0
+    for entry in os.scandir(UPLOAD_SPOOL_DIR):
+        if entry.is_file() and entry.stat().st_mtime < cutoff:
+            discard_spool_file(entry.path)
+            removed += 1
+    return removed
+
+
+def run_maintenance():
+    """Remove periodicamente entradas vencidas dos caches e uploads órfãos."""
     while True:
+        time.sleep(CACHE_PURGE_INTERVAL_SECONDS)
         try:
-            with data_lock:
-                now = datetime.now(timezone.utc)
-                # Limpa tarefas expiradas (aquelas cujo status deveria ter sido removido)
-                expired_tasks = [task_id for task_id, data in tasks.items()
-                                 if data.get('expires_at') and data['expires_at'] < now]
-                for task_id in expired_tasks:
-                    print(f"Cleaning up expired task status: {task_id}")
-                    result_id = tasks[task_id].get('result_id')
-                    # O resultado associado já deve ter sido tratado pela lógica de expiração em get_result
-                    # Apenas removemos a entrada da tarefa
-                    if task_id in tasks: # Verifica se ainda existe
-                        del tasks[task_id]
-
-                # Limpa resultados explicitamente expirados (caso get_result não tenha sido chamado)
-                expired_results = []
-                for result_id, data in results.items():
-                    expiration_time = data['created_at'] + timedelta(minutes=RESULT_EXPIRATION_MINUTES)
-                    if now >= expiration_time:
-                        print(f"Cleanup: Found explicitly expired result {result_id}")
-                        expired_results.append(result_id)
-
-                for result_id in expired_results:
-                    if result_id in results: # Verifica novamente
-                        print(f"Cleanup: Removing expired result {result_id}")
-                        del results[result_id]
-                        # Remove a tarefa associada se existir e não estiver processando
-                        task_to_remove = None
-                        for task_id, task_info in tasks.items():
-                            if task_info.get('result_id') == result_id and task_info.get('status') != 'processing':
-                                task_to_remove = task_id
-                                break
-                        if task_to_remove and task_to_remove in tasks:
-                            print(f"Cleanup: Removing associated task {task_to_remove}")
-                            del tasks[task_to_remove]
+            # Os caches respeitam a mesma janela de privacidade dos resultados
+            for cache in (transcript_cache, analysis_cache):
+                purged = cache.purge_expired()
+                if purged:
+                    logger.info(f"Cleanup: Removed {purged} expired entries from {cache.name} cache")
+            removed = purge_orphan_spool_files()
+            if removed:
+                logger.info(f"Cleanup: Removed {removed} orphan upload files")
+        except Exception as e:
+            logger.error(f"Error during maintenance: {e}")
+
+
+
+
+# --- Pool de Processamento ---
+class WorkerPool:
+    """Pool fixo de threads com uma fila de admissão limitada.
+
+    Em vez de uma thread por upload, as tarefas entram numa fila com tamanho
+    máximo e são consumidas por um número fixo de workers. Quando a fila está
+    cheia, submit() recusa a tarefa para que o endpoint responda com 503.
+    """
+
+    def __init__(self, num_workers, max_queued):
+        self.num_workers = max(1, num_workers)
+        self.max_queued = max(1, max_queued)
+        self._queue = deque() # Itens (task_id, func, args, enfileirado_em) aguardando um worker
+        self._cond = threading.Condition()
+        self._threads = []
+        self._avg_task_seconds = 30.0 # Estimativa inicial, ajustada por média móvel
+        self._active = 0
+
+    def start(self):
+        """Inicia as threads de processamento."""
+        for i in range(self.num_workers):
+            thread = threading.Thread(target=self._worker_loop, name=f"worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, task_id, func, *args):
+        """Enfileira uma tarefa. Retorna False se a fila estiver cheia."""
+        with self._cond:
+            if len(self._queue) >= self.max_queued:
+                return False
+            self._queue.append((task_id, func, args, time.monotonic()))
+            self._wake(1)
+            return True
+
+    def submit_many(self, items):
+        """Enfileira várias tarefas (task_id, func, args) de uma vez: todas ou nenhuma."""
+        with self._cond:
+            if len(self._queue) + len(items) > self.max_queued:
+                return False
+            enqueued_at = time.monotonic()
+            self._queue.extend((task_id, func, args, enqueued_at) for task_id, func, args in items)
+            self._wake(len(items))
+            return True
+
+    def queue_position(self, task_id):
+        """Posição (1-based) da tarefa na fila, ou None se já saiu da fila."""
+        with self._cond:
+            for position, (queued_id, _, _, _) in enumerate(self._queue, start=1):
+                if queued_id == task_id:
+                    return position
+        return None
 
+    def estimated_wait(self, position):
+        """Tempo estimado (segundos) até uma tarefa na posição dada começar."""
+        with self._cond:
+            avg = self._avg_task_seconds
+        # Cada "rodada" de workers consome num_workers tarefas da fila
+        rounds = (position + self.num_workers - 1) // self.num_workers
+        return int(rounds * avg)
+
+    def retry_after(self):
+        """Sugestão de Retry-After (segundos) quando a fila está cheia."""
+        with self._cond:
+            return max(1, int(self._avg_task_seconds * len(self._queue) / self.num_workers))
+
+    def stats(self):
+        """Snapshot do estado do pool."""
+        with self._cond:
+            return {'queued': len(self._queue), 'active': self._active}
+
+    def _wake(self, count):
+        """Avisa os workers de que há novas tarefas na fila. Requer o lock."""
+        self._cond.notify(count)
+
+    def _take(self):
+        """Retira a próxima tarefa da fila e a conta como ativa. Requer o lock."""
+        task_id, func, args, enqueued_at = self._queue.popleft()
+        self._active += 1
+        QUEUE_WAIT_SECONDS.observe(time.monotonic() - enqueued_at)
+        return task_id, func, args
+
+    def _finished(self, elapsed):
+        """Registra o fim de uma tarefa."""
+        with self._cond:
+            self._active -= 1
+            # Média móvel exponencial da duração das tarefas
+            self._avg_task_seconds = 0.8 * self._avg_task_seconds + 0.2 * elapsed
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                task_id, func, args = self._take()
+            start = time.time()
+            try:
+                func(task_id, *args)
+            except Exception as e:
+                logger.exception(f"Erro inesperado no worker ao processar tarefa {task_id}: {e}", extra={'task_id': task_id})
+            finally:
+                self._finished(time.time() - start)
+                # Libera a referência aos argumentos (bytes do áudio) o quanto antes
+                args = None
+
+
+class AsyncTaskEngine(WorkerPool):
+    """Motor de processamento num event loop asyncio, em uma thread ao lado do Flask.
+
+    Mantém a mesma fila de admissão do WorkerPool, mas as tarefas são corrotinas:
+    enquanto aguardam o Whisper ou o Gemini, não ocupam nenhuma thread. num_workers
+    passa a ser o número máximo de tarefas em andamento ao mesmo tempo.
+    """
+
+    def __init__(self, max_tasks, max_queued):
+        super().__init__(max_tasks, max_queued)
+        self.loop = None # Criado em start(), já no processo que vai usá-lo (depois do fork)
+        self._running = set() # Referências às tarefas asyncio em andamento
+
+    def start(self):
+        """Cria o event loop e inicia a thread que o executa."""
+        self.loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self.loop.run_forever, name="async-engine", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def run(self, coro):
+        """Executa uma corrotina no event loop e aguarda o resultado (para chamadas de outras threads)."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def _wake(self, count):
+        self.loop.call_soon_threadsafe(self._dispatch)
+
+    def _dispatch(self):
+        """Inicia tarefas da fila enquanto houver vagas. Roda no event loop."""
+        with self._cond:
+            while self._queue and self._active < self.num_workers:
+                task_id, func, args = self._take()
+                task = self.loop.create_task(self._run_task(task_id, func, args))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+    async def _run_task(self, task_id, func, args):
+        start = time.time()
+        try:
+            await func(task_id, *args)
         except Exception as e:
-            print(f"Error during cleanup: {e}") # Log do erro
+            logger.exception(f"Erro inesperado no motor assíncrono ao processar tarefa {task_id}: {e}", extra={'task_id': task_id})
+        finally:
+            self._finished(time.time() - start)
+            self._dispatch()
+
+
+# Limita chamadas simultâneas por estágio (Whisper vs Gemini)
+whisper_slots = threading.BoundedSemaphore(max(1, WHISPER_CONCURRENCY))
+gemini_slots = threading.BoundedSemaphore(max(1, GEMINI_CONCURRENCY))
+# Equivalentes para o motor assíncrono (usados apenas dentro do event loop)
+async_whisper_slots = asyncio.BoundedSemaphore(max(1, WHISPER_CONCURRENCY))
+async_gemini_slots = asyncio.BoundedSemaphore(max(1, GEMINI_CONCURRENCY))
+async_chunk_slots = asyncio.BoundedSemaphore(max(1, CHUNK_CONCURRENCY))
+async_map_slots = asyncio.BoundedSemaphore(max(1, ANALYSIS_MAP_CONCURRENCY))
+
+# Pool de processamento (as threads são iniciadas em start_background_services)
+if ASYNC_ENGINE:
+    worker_pool = AsyncTaskEngine(ASYNC_MAX_TASKS, MAX_QUEUED_TASKS)
+else:
+    worker_pool = WorkerPool(WORKER_THREADS, MAX_QUEUED_TASKS)
 
-        # Espera um tempo antes da próxima limpeza (ex: 5 minutos)
-        time.sleep(300)
+metrics_registry.register(Gauge('braindump_tasks_in_flight', 'Tarefas sendo processadas agora.',
+                                callback=lambda: worker_pool.stats()['active']))
+metrics_registry.register(Gauge('braindump_tasks_queued', 'Tarefas aguardando na fila de admissão.',
+                                callback=lambda: worker_pool.stats()['queued']))
 
-# Inicia a thread de limpeza em background
-cleanup_thread = threading.Thread(target=cleanup_expired_data, daemon=True)
-cleanup_thread.start()
 
+# --- Monitoramento de Memória ---
+def current_rss_bytes():
+    """Memória residente (RSS) atual do processo, ou None se indisponível (fora do Linux)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
 
-# --- Funções de Processamento (Reais) ---
 
-def transcribe_audio_with_whisper(audio_bytes, original_filename):
-    """Transcreve o áudio usando a API Whisper da OpenAI."""
-    if not openai.api_key:
-        raise ValueError("Chave da API OpenAI não configurada.")
+class RssMonitor:
+    """Amostra o RSS do processo enquanto há tarefas em andamento.
+
+    Para cada tarefa registra o RSS no início e o pico observado durante a
+    execução. Como as tarefas dividem o processo, a diferença é uma
+    aproximação do custo de cada uma, útil para dimensionar instâncias.
+    """
+
+    def __init__(self, interval_seconds=0.5):
+        self.interval_seconds = interval_seconds
+        self._tracked = {} # task_id -> [rss_inicial, rss_pico]
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def track(self, task_id):
+        rss = current_rss_bytes()
+        if rss is None:
+            return
+        with self._lock:
+            self._tracked[task_id] = [rss, rss]
+            if self._thread is None:
+                # A thread de amostragem só é criada quando a primeira tarefa começa
+                self._thread = threading.Thread(target=self._sample_loop, name="rss-monitor", daemon=True)
+                self._thread.start()
+
+    def finish(self, task_id):
+        """Encerra o acompanhamento. Retorna {'peak_rss_mb', 'rss_delta_mb'} ou None."""
+        rss = current_rss_bytes()
+        with self._lock:
+            entry = self._tracked.pop(task_id, None)
+        if entry is None:
+            return None
+        start, peak = entry[0], max(entry[1], rss or 0)
+        return {
+            'peak_rss_mb': round(peak / (1024 * 1024), 1),
+            'rss_delta_mb': round((peak - start) / (1024 * 1024), 1),
+        }
+
+    def _sample_loop(self):
+        while True:
+            time.sleep(self.interval_seconds)
+            with self._lock:
+                if not self._tracked:
+                    continue
+            rss = current_rss_bytes()
+            with self._lock:
+                for entry in self._tracked.values():
+                    entry[1] = max(entry[1], rss)
+
+
+rss_monitor = RssMonitor()
+
+
+# --- Clientes das APIs ---
+# Os clientes mantêm pools de conexões HTTP (keep-alive), então o handshake TLS
+# acontece uma vez por conexão, e não a cada tarefa.
+ANALYSIS_INSTRUCTIONS = """
+Analise a transcrição de uma nota de voz pessoal enviada pelo usuário, que representa um fluxo de consciência. Aja como um assistente reflexivo e útil. Sua análise deve ser estruturada em Markdown e incluir as seguintes seções:
+
+1.  **Resumo dos Pontos Principais:** Identifique e liste os temas ou ideias centrais discutidos.
+2.  **Problemas ou Desafios:** Liste quaisquer problemas, preocupações ou dificuldades expressas pelo usuário.
+3.  **Conexões e Possíveis Causas:** Explore possíveis ligações entre os diferentes pontos ou problemas mencionados. Se possível, sugira causas subjacentes para os desafios identificados (apresente como hipóteses, não certezas).
+4.  **Próximos Passos Acionáveis:** Sugira 3-5 passos concretos e práticos que o usuário poderia tomar para abordar os desafios, explorar as ideias ou ganhar clareza. Foque em ações pequenas e gerenciáveis.
+
+Formate toda a resposta usando Markdown. Use cabeçalhos (##) para cada seção. Use listas de marcadores (*) ou numeradas (1.) conforme apropriado. Mantenha um tom empático e construtivo. Não inclua a transcrição.
+"""
+
+SUMMARY_INSTRUCTIONS = """
+Você vai receber as análises de várias notas de voz pessoais do mesmo usuário, gravadas em sequência. Aja como um assistente reflexivo e útil e produza uma visão geral em Markdown com as seções:
+
+1.  **Temas Recorrentes:** Ideias ou assuntos que aparecem em mais de uma nota.
+2.  **Padrões entre os Desafios:** Como os problemas das diferentes notas se relacionam.
+3.  **Próximos Passos Consolidados:** 3-5 passos concretos que abordem o conjunto das notas, sem repetir cada nota individualmente.
+
+Use cabeçalhos (###) para cada seção. Mantenha um tom empático e construtivo.
+"""
+
+# Análise em partes (map-reduce): notas por segmento e a junção no relatório final
+SEGMENT_INSTRUCTIONS = """
+Você vai receber um trecho da transcrição de uma nota de voz pessoal longa, que representa um fluxo de consciência do usuário. Extraia notas objetivas deste trecho, em Markdown, com as seções:
+
+1.  **Pontos Principais:** Temas ou ideias centrais do trecho.
+2.  **Problemas ou Desafios:** Problemas, preocupações ou dificuldades expressas.
+3.  **Conexões:** Ligações entre os pontos do trecho e possíveis causas (como hipóteses).
+
+Seja conciso: as notas de todos os trechos serão combinadas depois numa única análise.
+"""
+
+REDUCE_INSTRUCTIONS = """
+Você vai receber notas extraídas, em ordem, dos trechos de uma única nota de voz pessoal longa, que representa um fluxo de consciência do usuário. Aja como um assistente reflexivo e útil e combine as notas numa análise única, estruturada em Markdown, com as seguintes seções:
+
+1.  **Resumo dos Pontos Principais:** Identifique e liste os temas ou ideias centrais da nota inteira, sem repetições entre trechos.
+2.  **Problemas ou Desafios:** Liste quaisquer problemas, preocupações ou dificuldades expressas pelo usuário.
+3.  **Conexões e Possíveis Causas:** Explore possíveis ligações entre os diferentes pontos ou problemas mencionados, inclusive entre trechos distantes. Se possível, sugira causas subjacentes para os desafios identificados (apresente como hipóteses, não certezas).
+4.  **Próximos Passos Acionáveis:** Sugira 3-5 passos concretos e práticos que o usuário poderia tomar para abordar os desafios, explorar as ideias ou ganhar clareza. Foque em ações pequenas e gerenciáveis.
+
+Formate toda a resposta usando Markdown. Use cabeçalhos (##) para cada seção. Use listas de marcadores (*) ou numeradas (1.) conforme apropriado. Mantenha um tom empático e construtivo. Não inclua a transcrição.
+"""
+
+# O texto fixo dos prompts vai como instrução de sistema do modelo; cada chamada envia só o conteúdo
+GEMINI_INSTRUCTIONS = {'analysis': ANALYSIS_INSTRUCTIONS, 'summary': SUMMARY_INSTRUCTIONS,
+                       'segment': SEGMENT_INSTRUCTIONS, 'reduce': REDUCE_INSTRUCTIONS}
+
+api_clients_lock = threading.Lock()
+openai_client = None
+async_openai_client = None # Criado no event loop do motor assíncrono, na primeira chamada
+gemini_models = {} # Tipo de prompt -> GenerativeModel
+
+
+def http_pool_limits():
+    """Limites do pool de conexões HTTP dos clientes OpenAI."""
+    import httpx
+    return httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                        max_keepalive_connections=HTTP_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=HTTP_KEEPALIVE_SECONDS)
+
+
+def get_openai_client():
+    """Cliente OpenAI síncrono compartilhado entre as threads."""
+    global openai_client
+    if openai_client is None:
+        with api_clients_lock:
+            if openai_client is None:
+                import openai
+                # As novas tentativas ficam com o whisper_caller (max_retries=0 no cliente)
+                openai_client = openai.OpenAI(api_key=openai_api_key, timeout=API_TIMEOUT_SECONDS, max_retries=0,
+                                              http_client=openai.DefaultHttpxClient(limits=http_pool_limits()))
+    return openai_client
+
+
+def get_async_openai_client():
+    """Cliente OpenAI assíncrono compartilhado (só deve ser usado no event loop do motor)."""
+    global async_openai_client
+    if async_openai_client is None:
+        import openai
+        async_openai_client = openai.AsyncOpenAI(api_key=openai_api_key, timeout=API_TIMEOUT_SECONDS, max_retries=0,
+                                                 http_client=openai.DefaultAsyncHttpxClient(limits=http_pool_limits()))
+    return async_openai_client
+
+
+def get_gemini_model(kind):
+    """Modelo Gemini compartilhado, já com a instrução de sistema do tipo de prompt ('analysis' ou 'summary')."""
+    with api_clients_lock:
+        model = gemini_models.get(kind)
+        if model is None:
+            import google.generativeai as genai
+            if not gemini_models: # Primeiro modelo do processo: configura o SDK
+                genai.configure(api_key=google_api_key)
+            # Veja modelos disponíveis: https://ai.google.dev/models/gemini
+            model = gemini_models[kind] = genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=GEMINI_INSTRUCTIONS[kind])
+        return model
+
+
+def warm_up_api_clients():
+    """Cria os clientes (importando os SDKs) e abre as conexões antes da primeira tarefa (API_WARMUP)."""
+    if openai_api_key:
+        client = get_openai_client()
+        try:
+            client.with_options(timeout=10, max_retries=0).models.retrieve("whisper-1")
+        except Exception as e:
+            logger.warning(f"Aquecimento da conexão com a OpenAI falhou: {e}")
+    if google_api_key:
+        for kind in GEMINI_INSTRUCTIONS:
+            get_gemini_model(kind)
+        try:
+            import google.generativeai as genai
+            genai.get_model(f"models/{GEMINI_MODEL_NAME}", request_options={'timeout': 10})
+        except Exception as e:
+            logger.warning(f"Aquecimento da conexão com o Gemini falhou: {e}")
+
+
+# --- Resiliência das Chamadas às APIs ---
+def is_retryable_api_error(error):
+    """Erros temporários (timeout, conexão, 429, 5xx), que valem uma nova tentativa."""
+    import httpx
+    import openai
+    from google.api_core import exceptions as google_exceptions
+    if isinstance(error, (TimeoutError, ConnectionError, httpx.TimeoutException, httpx.TransportError,
+                          openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    if isinstance(error, google_exceptions.GoogleAPICallError):
+        return error.code is not None and (error.code in (408, 429) or error.code >= 500)
+    return False
 
-    print(f"Iniciando transcrição Whisper para {original_filename}...")
-    try:
-        # A API Whisper precisa de um objeto tipo arquivo. Usamos BytesIO.
-        # É crucial passar um nome de arquivo com a extensão correta na tupla.
-        audio_file = io.BytesIO(audio_bytes)
-        audio_file.name = original_filename # Atribui nome ao objeto BytesIO
-
-        # Chama a API de transcrição
-        # Veja a documentação para mais opções: https://platform.openai.com/docs/api-reference/audio/createTranscription
-        transcript = openai.audio.transcriptions.create(
-            model="whisper-1",
-            file=audio_file, # Passa o objeto BytesIO diretamente
-            response_format="text" # Pede o texto diretamente
-            # language="pt" # Opcional: pode tentar forçar o idioma
-        )
-        print("Transcrição Whisper concluída.")
-        # O objeto retornado pode variar, ajuste conforme necessário.
-        # Se response_format="text", a resposta deve ser uma string.
-        return transcript # Retorna diretamente o texto da transcrição
 
+def create_api_caller(api, deadline_seconds):
+    """Caller com as políticas de resiliência configuradas, com seu próprio circuit breaker."""
+    return ResilientCaller(
+        api, deadline_seconds=deadline_seconds, attempt_timeout=API_TIMEOUT_SECONDS,
+        max_attempts=API_MAX_ATTEMPTS, backoff_base=API_RETRY_BASE_SECONDS, backoff_max=API_RETRY_MAX_SECONDS,
+        is_retryable=is_retryable_api_error,
+        breaker=CircuitBreaker(api, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS),
+        hedging=API_HEDGING, hedge_quantile=API_HEDGE_QUANTILE,
+        on_event=lambda event: API_RESILIENCE_EVENTS.inc(api=api, event=event))
+
+
+whisper_caller = create_api_caller('whisper', WHISPER_DEADLINE_SECONDS)
+gemini_caller = create_api_caller('gemini', GEMINI_DEADLINE_SECONDS)
+
+
+def upstream_retry_after():
+    """Segundos até as APIs voltarem a aceitar chamadas (0 se nenhum circuito estiver aberto)."""
+    return max(whisper_caller.breaker.retry_after(), gemini_caller.breaker.retry_after())
+
+
+def open_audio_source(audio_source):
+    """Abre o áudio (caminho de arquivo ou bytes) para uma tentativa de envio."""
+    if isinstance(audio_source, (bytes, bytearray)):
+        return io.BytesIO(audio_source)
+    return open(audio_source, 'rb')
+
+
+# --- Funções de Processamento (Reais) ---
+
+# Executor compartilhado para os trechos de áudio: limita as chamadas simultâneas
+# ao Whisper no modo em partes, independentemente de quantas tarefas estão ativas
+chunk_executor = ThreadPoolExecutor(max_workers=max(1, CHUNK_CONCURRENCY), thread_name_prefix="whisper-chunk")
+
+
+def request_whisper_transcription(audio_source, filename, on_retry=None, deadline=None):
+    """Transcreve um áudio (caminho ou bytes) com a API Whisper e retorna o texto.
+
+    A chamada passa pelo whisper_caller (prazo, novas tentativas, hedging e
+    circuit breaker); cada tentativa abre o áudio de novo. deadline é o prazo
+    do estágio, quando ele é dividido em várias chamadas.
+    """
+    def attempt(timeout):
+        with open_audio_source(audio_source) as audio_file:
+            # Chama a API de transcrição
+            # Veja a documentação para mais opções: https://platform.openai.com/docs/api-reference/audio/createTranscription
+            return get_openai_client().audio.transcriptions.create(
+                model="whisper-1",
+                # É crucial passar um nome de arquivo com a extensão correta na tupla.
+                # O arquivo é enviado em streaming, sem carregá-lo inteiro na memória.
+                file=(filename, audio_file),
+                response_format="text", # Pede o texto diretamente (uma string)
+                # language="pt" # Opcional: pode tentar forçar o idioma
+                timeout=timeout
+            )
+    return whisper_caller.call(attempt, on_retry=on_retry, deadline=deadline)
+
+
+def run_ffmpeg(arguments):
+    """Executa o ffmpeg (o mesmo binário usado pelo pydub) e retorna a saída padrão."""
+    from pydub import AudioSegment
+    result = subprocess.run([AudioSegment.converter, "-nostdin", "-v", "error", *arguments], capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg falhou: {result.stderr.decode(errors='replace')[-500:]}")
+    return result.stdout
+
+
+def extract_audio_range(audio_path, start_ms, end_ms, output_args):
+    """Decodifica só o intervalo [start_ms, end_ms) do arquivo com o ffmpeg e retorna a saída.
+
+    O -ss antes do -i faz o ffmpeg pular direto para o início do intervalo, sem
+    decodificar (nem manter na memória) o restante do áudio.
+    """
+    return run_ffmpeg(["-ss", f"{start_ms / 1000:.3f}", "-t", f"{(end_ms - start_ms) / 1000:.3f}",
+                       "-i", audio_path, "-vn", *output_args, "-"])
+
+
+def load_audio_window(audio_path, start_ms, end_ms):
+    """Janela do áudio em PCM mono a PREPROCESS_SAMPLE_RATE, para a busca por silêncios."""
+    from pydub import AudioSegment
+    data = extract_audio_range(audio_path, start_ms, end_ms,
+                               ["-ac", "1", "-ar", str(PREPROCESS_SAMPLE_RATE), "-f", "s16le"])
+    return AudioSegment(data=data, sample_width=2, frame_rate=PREPROCESS_SAMPLE_RATE, channels=1)
+
+
+def split_audio_on_silence(audio_path, total_ms):
+    """Calcula os intervalos (início, fim) em ms dos trechos a transcrever.
+
+    Cada corte é feito no silêncio mais próximo da duração alvo (ou na própria
+    duração alvo, se não houver silêncio) e os trechos vizinhos se sobrepõem em
+    CHUNK_OVERLAP_SECONDS para não perder palavras na fronteira. Só as janelas
+    em torno dos cortes são decodificadas.
+    """
+    from pydub.silence import detect_silence
+    target_ms = CHUNK_TARGET_SECONDS * 1000
+    overlap_ms = int(CHUNK_OVERLAP_SECONDS * 1000)
+    search_ms = target_ms // 4 # Janela de busca por silêncio em torno do corte ideal
+
+    cuts = [0]
+    while total_ms - cuts[-1] > target_ms + search_ms:
+        ideal = cuts[-1] + target_ms
+        window_start = ideal - search_ms
+        window = load_audio_window(audio_path, window_start, ideal + search_ms)
+        # O limiar de silêncio é relativo ao volume da própria janela
+        silence_thresh = window.dBFS - 16 if window.dBFS != float('-inf') else -50
+        # Analisa apenas a janela, com passo de 10ms, para não percorrer o áudio inteiro
+        silences = detect_silence(window, min_silence_len=400, silence_thresh=silence_thresh, seek_step=10)
+        if silences:
+            # Corta no meio do silêncio mais próximo do ponto ideal
+            middles = [window_start + (start + end) // 2 for start, end in silences]
+            cut = min(middles, key=lambda m: abs(m - ideal))
+        else:
+            cut = ideal
+        cuts.append(cut)
+    cuts.append(total_ms)
+
+    return [(max(0, start - overlap_ms), min(total_ms, end + overlap_ms))
+            for start, end in zip(cuts, cuts[1:])]
+
+
+def _normalize_words(text):
+    """Palavras em minúsculas e sem pontuação, para comparar sobreposições."""
+    return [re.sub(r"[^\w]", "", word.lower()) for word in text.split()]
+
+
+def merge_transcript_chunks(texts, window=30):
+    """Junta as transcrições dos trechos, removendo o texto duplicado na sobreposição."""
+    merged_words = []
+    for text in texts:
+        words = text.split()
+        if merged_words and words:
+            tail = _normalize_words(" ".join(merged_words[-window:]))
+            head = _normalize_words(" ".join(words[:window]))
+            skip = 0
+            # Procura a maior sequência final do texto anterior que reaparece
+            # (quase) no início do trecho seguinte
+            for size in range(min(len(tail), len(head)), 0, -1):
+                suffix = tail[-size:]
+                # Uma única palavra repetida só conta se estiver exatamente na fronteira
+                max_offset = 0 if size == 1 else min(5, len(head) - size)
+                found = next((offset for offset in range(0, max_offset + 1)
+                              if head[offset:offset + size] == suffix), None)
+                if found is not None:
+                    skip = found + size
+                    break
+            words = words[skip:]
+        merged_words.extend(words)
+    return " ".join(merged_words)
+
+
+def export_audio_chunk(audio_path, start, end):
+    """Exporta o trecho [start, end) ms do arquivo como MP3 mono e retorna os bytes."""
+    return extract_audio_range(audio_path, start, end, ["-ac", "1", "-b:a", "64k", "-f", "mp3"])
+
+
+def should_transcribe_in_chunks(audio_path, duration):
+    """Áudios curtos (e dentro do limite da API) continuam em uma única chamada."""
+    return os.path.getsize(audio_path) > WHISPER_MAX_BYTES or duration > 2 * CHUNK_TARGET_SECONDS
+
+
+def transcribe_audio_in_chunks(audio_path, total_ms, original_filename, on_retry=None):
+    """Transcreve um áudio longo em trechos paralelos e junta o texto em ordem.
+
+    Cada trecho é extraído do arquivo quando vai ser enviado, sem decodificar o áudio
+    inteiro. Todos os trechos dividem o prazo de WHISPER_DEADLINE_SECONDS da transcrição.
+    """
+    deadline = whisper_caller.stage_deadline()
+    ranges = split_audio_on_silence(audio_path, total_ms)
+    base_name = os.path.splitext(original_filename)[0]
+    logger.info(f"Transcrição em partes para {original_filename}: {len(ranges)} trechos.")
+
+    def transcribe_range(index_and_range):
+        index, (start, end) = index_and_range
+        chunk_data = export_audio_chunk(audio_path, start, end)
+        return request_whisper_transcription(chunk_data, f"{base_name}_{index}.mp3", on_retry, deadline)
+
+    # map() preserva a ordem dos trechos, mesmo concluindo fora de ordem
+    texts = list(chunk_executor.map(transcribe_range, enumerate(ranges)))
+    return merge_transcript_chunks(texts)
+
+
+def silence_filter():
+    """Filtro do ffmpeg que remove o silêncio inicial e encurta os silêncios longos.
+
+    Silêncios internos (e o final) maiores que SILENCE_MAX_SECONDS ficam com cerca de
+    SILENCE_MAX_SECONDS, preservando as pausas entre frases.
+    """
+    # O ffmpeg 7 mantém stop_duration + stop_silence de cada silêncio longo; versões
+    # anteriores mantêm só stop_silence. Com metade em cada, a pausa nunca some
+    half_seconds = SILENCE_MAX_SECONDS / 2
+    return (f"silenceremove=start_periods=1:start_threshold={SILENCE_THRESHOLD_DB}dB"
+            f":start_silence={SILENCE_PADDING_MS / 1000}"
+            f":stop_periods=-1:stop_duration={half_seconds}:stop_threshold={SILENCE_THRESHOLD_DB}dB"
+            f":stop_silence={half_seconds}")
+
+
+def preprocess_audio(task_id, audio_path, original_filename):
+    """Prepara o áudio para o Whisper: mono, PREPROCESS_SAMPLE_RATE, silêncios cortados e MP3.
+
+    Retorna (caminho, nome do arquivo) do áudio a transcrever. Se o pré-processamento
+    estiver desativado, falhar ou não reduzir o arquivo, retorna o áudio original.
+    """
+    if not AUDIO_PREPROCESSING:
+        return audio_path, original_filename
+    log_extra = {'task_id': task_id, 'stage': 'preprocessing'}
+    stage_start = time.perf_counter()
+    output_path = None
+    try:
+        fd, output_path = create_spool_file(".mp3")
+        os.close(fd)
+        # Uma única passagem do ffmpeg, de arquivo para arquivo: o áudio é convertido em
+        # fluxo, sem ser decodificado inteiro na memória
+        run_ffmpeg(["-y", "-i", audio_path, "-vn", "-ac", "1", "-ar", str(PREPROCESS_SAMPLE_RATE),
+                    "-af", silence_filter(), "-b:a", PREPROCESS_BITRATE, "-f", "mp3", output_path])
+    except Exception as e:
+        if output_path:
+            discard_spool_file(output_path)
+        logger.warning(f"Task {task_id}: Pré-processamento falhou, enviando o áudio original: {e}", extra=log_extra)
+        return audio_path, original_filename
+
+    original_bytes = os.path.getsize(audio_path)
+    output_bytes = os.path.getsize(output_path)
+    # As durações vêm dos metadados (0 se não for possível lê-las)
+    original_seconds = probe_audio_duration(audio_path) or 0
+    trimmed_seconds = probe_audio_duration(output_path) or original_seconds
+    if output_bytes == 0 or (output_bytes >= original_bytes and trimmed_seconds >= original_seconds):
+        discard_spool_file(output_path)
+        logger.info(f"Task {task_id}: Pré-processamento não reduziu o áudio; usando o original.", extra=log_extra)
+        return audio_path, original_filename
+
+    elapsed = time.perf_counter() - stage_start
+    saved_bytes = original_bytes - output_bytes
+    saved_seconds = original_seconds - trimmed_seconds
+    PREPROCESS_SECONDS.observe(elapsed)
+    PREPROCESS_SAVED_BYTES.inc(max(saved_bytes, 0))
+    PREPROCESS_SAVED_SECONDS.inc(max(saved_seconds, 0))
+    logger.info(f"Task {task_id}: Pré-processamento reduziu o áudio de {original_bytes} para {output_bytes} bytes "
+                f"e de {original_seconds:.1f}s para {trimmed_seconds:.1f}s em {elapsed:.2f}s.",
+                extra=dict(log_extra, seconds=round(elapsed, 3), saved_bytes=saved_bytes,
+                           saved_audio_seconds=round(saved_seconds, 3)))
+    return output_path, f"{os.path.splitext(original_filename)[0]}.mp3"
+
+
+@contextmanager
+def whisper_errors():
+    """Contabiliza e padroniza os erros da transcrição (nas versões síncrona e assíncrona)."""
+    import openai
+    try:
+        yield
     except openai.APIError as e:
-        print(f"Erro na API OpenAI: {e}")
+        API_ERRORS.inc(api='whisper')
+        logger.error(f"Erro na API OpenAI: {e}")
         raise Exception(f"Erro na API de transcrição: {e}") from e
     except Exception as e:
-        print(f"Erro inesperado durante a transcrição: {e}")
+        API_ERRORS.inc(api='whisper')
+        logger.error(f"Erro inesperado durante a transcrição: {e}")
         raise Exception(f"Erro inesperado na transcrição: {e}") from e
 
 
-def analyze_transcript_with_gemini(transcript):
-    """Analisa a transcrição usando a API Gemini do Google."""
+def chunked_transcription_duration(audio_path):
+    """Duração do áudio (s) se ele deve ser transcrito em trechos; None para uma única chamada."""
+    if not CHUNKED_TRANSCRIPTION:
+        return None
+    duration = probe_audio_duration(audio_path)
+    if duration is None and os.path.getsize(audio_path) > WHISPER_MAX_BYTES:
+        raise ValueError("Não foi possível ler a duração do áudio para dividi-lo em trechos.")
+    # Sem a duração, um áudio dentro do limite da API segue numa única chamada
+    return duration if duration and should_transcribe_in_chunks(audio_path, duration) else None
+
+
+def transcribe_audio_with_whisper(audio_path, original_filename, on_retry=None):
+    """Transcreve o arquivo de áudio usando a API Whisper da OpenAI.
+
+    on_retry é chamado antes de cada nova tentativa (veja ResilientCaller).
+    """
+    if not openai_api_key:
+        raise ValueError("Chave da API OpenAI não configurada.")
+
+    logger.info(f"Iniciando transcrição Whisper para {original_filename}...")
+    with whisper_errors():
+        duration = chunked_transcription_duration(audio_path)
+        if duration:
+            transcript = transcribe_audio_in_chunks(audio_path, int(duration * 1000), original_filename, on_retry)
+        else:
+            transcript = request_whisper_transcription(audio_path, original_filename, on_retry)
+    logger.info("Transcrição Whisper concluída.")
+    return transcript # Retorna diretamente o texto da transcrição
+
+
+# --- Versões assíncronas (motor asyncio) ---
+async def request_whisper_transcription_async(audio_source, filename, on_retry=None, deadline=None):
+    """Versão assíncrona de request_whisper_transcription."""
+    async def attempt(timeout):
+        with open_audio_source(audio_source) as audio_file:
+            return await get_async_openai_client().audio.transcriptions.create(
+                model="whisper-1",
+                file=(filename, audio_file),
+                response_format="text",
+                timeout=timeout
+            )
+    return await whisper_caller.call_async(attempt, on_retry=on_retry, deadline=deadline)
+
+
+async def transcribe_audio_in_chunks_async(audio_path, total_ms, original_filename, on_retry=None):
+    """Versão assíncrona de transcribe_audio_in_chunks: os trechos são chamadas concorrentes no loop."""
+    deadline = whisper_caller.stage_deadline()
+    # Detectar silêncios e codificar MP3 usa CPU: roda fora do event loop
+    ranges = await asyncio.to_thread(split_audio_on_silence, audio_path, total_ms)
+    base_name = os.path.splitext(original_filename)[0]
+    logger.info(f"Transcrição em partes para {original_filename}: {len(ranges)} trechos.")
+
+    async def transcribe_range(index, start, end):
+        async with async_chunk_slots:
+            chunk_data = await asyncio.to_thread(export_audio_chunk, audio_path, start, end)
+            return await request_whisper_transcription_async(chunk_data, f"{base_name}_{index}.mp3", on_retry,
+                                                             deadline)
+
+    # gather() preserva a ordem dos trechos, mesmo concluindo fora de ordem
+    texts = await asyncio.gather(*(transcribe_range(index, start, end) for index, (start, end) in enumerate(ranges)))
+    return merge_transcript_chunks(texts)
+
+
+async def transcribe_audio_with_whisper_async(audio_path, original_filename, on_retry=None):
+    """Versão assíncrona de transcribe_audio_with_whisper."""
+    if not openai_api_key:
+        raise ValueError("Chave da API OpenAI não configurada.")
+
+    logger.info(f"Iniciando transcrição Whisper para {original_filename}...")
+    with whisper_errors():
+        duration = await asyncio.to_thread(chunked_transcription_duration, audio_path)
+        if duration:
+            transcript = await transcribe_audio_in_chunks_async(audio_path, int(duration * 1000), original_filename,
+                                                                on_retry)
+        else:
+            transcript = await request_whisper_transcription_async(audio_path, original_filename, on_retry)
+    logger.info("Transcrição Whisper concluída.")
+    return transcript
+
+
+ANALYSIS_DISCLAIMER = "\n\n*Esta análise foi gerada por IA e destina-se a fins de reflexão. Não substitui aconselhamento profissional.*"
+
+# Executor compartilhado para os segmentos da análise em partes (limite global de chamadas)
+analysis_map_executor = ThreadPoolExecutor(max_workers=max(1, ANALYSIS_MAP_CONCURRENCY), thread_name_prefix="gemini-map")
+
+
+def build_analysis_prompt(transcript):
+    """Monta o conteúdo enviado a cada análise (as instruções fixas estão no modelo)."""
+    return f"**Transcrição para Análise:**\n---\n{transcript}\n---\n\n**Análise Formatada em Markdown:**"
+
+
+def build_segment_prompt(index, total, segment):
+    """Conteúdo enviado na análise de um segmento (etapa map)."""
+    return f"**Trecho {index} de {total} da transcrição:**\n---\n{segment}\n---\n\n**Notas do Trecho em Markdown:**"
+
+
+def build_reduce_prompt(segment_notes):
+    """Conteúdo enviado na junção das notas dos segmentos (etapa reduce)."""
+    notes = "\n\n".join(f"### Trecho {index}\n{note}" for index, note in enumerate(segment_notes, start=1))
+    return f"**Notas dos Trechos, em Ordem:**\n---\n{notes}\n---\n\n**Análise Formatada em Markdown:**"
+
+
+def count_prompt_tokens(model, prompt):
+    """Tokens de entrada do prompt.
+
+    Usa a estimativa local enquanto ela está longe do orçamento; perto dele,
+    consulta a contagem do próprio modelo (que inclui a instrução de sistema).
+    """
+    estimate = len(prompt) // CHARS_PER_TOKEN_ESTIMATE
+    if estimate < GEMINI_MAX_INPUT_TOKENS // 2:
+        return estimate
+    try:
+        return model.count_tokens(prompt, request_options={'timeout': 10}).total_tokens
+    except Exception as e:
+        logger.warning(f"Contagem de tokens do Gemini falhou, usando a estimativa local: {e}")
+        return estimate
+
+
+def truncate_text(text, max_chars):
+    """Corta o texto em até max_chars, no último espaço, marcando o corte."""
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind(" ", 0, max_chars)
+    return text[:cut if cut > 0 else max_chars] + " [...]"
+
+
+def build_prompt_within_budget(model, build_prompt, texts):
+    """Monta o prompt com build_prompt(texts), encurtando os textos por igual até caber em GEMINI_MAX_INPUT_TOKENS."""
+    prompt = build_prompt(texts)
+    for _ in range(3):
+        tokens = count_prompt_tokens(model, prompt)
+        if tokens <= GEMINI_MAX_INPUT_TOKENS:
+            break
+        # Margem de 10% para a parte fixa do prompt e para a diferença entre estimativa e contagem
+        ratio = GEMINI_MAX_INPUT_TOKENS / tokens * 0.9
+        logger.warning(f"Prompt com {tokens} tokens excede o orçamento de {GEMINI_MAX_INPUT_TOKENS}; "
+                       f"encurtando {len(texts)} textos para {ratio:.0%}.")
+        texts = [truncate_text(text, int(len(text) * ratio)) for text in texts]
+        prompt = build_prompt(texts)
+    return prompt
+
+
+def needs_long_analysis(transcript):
+    """Se a transcrição deve ser analisada em partes: pelo tamanho ou pelo orçamento de tokens."""
+    if len(transcript) > LONG_TRANSCRIPT_CHARS:
+        return True
+    return count_prompt_tokens(get_gemini_model('analysis'), build_analysis_prompt(transcript)) > GEMINI_MAX_INPUT_TOKENS
+
+
+def split_transcript(transcript, max_chars):
+    """Divide a transcrição em segmentos de até max_chars, cortando entre frases.
+
+    Frases maiores que o limite (ex: transcrições sem pontuação) são cortadas entre palavras.
+    """
+    pieces = []
+    for sentence in re.split(r'(?<=[.!?…])\s+|\n+', transcript):
+        sentence = sentence.strip()
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(' ', 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            pieces.append(sentence[:cut])
+            sentence = sentence[cut:].lstrip()
+        if sentence:
+            pieces.append(sentence)
+
+    segments = []
+    current, current_size = [], 0
+    for piece in pieces:
+        if current and current_size + 1 + len(piece) > max_chars:
+            segments.append(" ".join(current))
+            current, current_size = [], 0
+        current.append(piece)
+        current_size += len(piece) + (1 if current_size else 0)
+    if current:
+        segments.append(" ".join(current))
+    return segments
+
+
+def generate_gemini_text(model, prompt, on_chunk=None, on_retry=None, deadline=None):
+    """Chama o Gemini e retorna o texto; com on_chunk, em streaming, repassando cada fragmento.
+
+    A chamada passa pelo gemini_caller. Chamadas em streaming não são duplicadas
+    (hedging), e uma nova tentativa recomeça o texto: on_retry deve descartar
+    os fragmentos já repassados. deadline é o prazo do estágio (veja ResilientCaller).
+    """
+    def attempt(timeout):
+        request_options = {'timeout': timeout}
+        if on_chunk is None:
+            # A resposta geralmente está em response.text
+            return model.generate_content(prompt, request_options=request_options).text
+        fragments = []
+        for chunk in model.generate_content(prompt, stream=True, request_options=request_options):
+            try:
+                text = chunk.text
+            except ValueError:
+                # Fragmentos sem texto (ex: apenas metadados de segurança)
+                continue
+            fragments.append(text)
+            on_chunk(text)
+        return "".join(fragments)
+    return gemini_caller.call(attempt, on_retry=on_retry, hedge=on_chunk is None, deadline=deadline)
+
+
+async def generate_gemini_text_async(model, prompt, on_chunk=None, on_retry=None, deadline=None):
+    """Versão assíncrona de generate_gemini_text (generate_content_async)."""
+    async def attempt(timeout):
+        request_options = {'timeout': timeout}
+        if on_chunk is None:
+            return (await model.generate_content_async(prompt, request_options=request_options)).text
+        fragments = []
+        async for chunk in await model.generate_content_async(prompt, stream=True, request_options=request_options):
+            try:
+                text = chunk.text
+            except ValueError:
+                continue
+            fragments.append(text)
+            on_chunk(text)
+        return "".join(fragments)
+    return await gemini_caller.call_async(attempt, on_retry=on_retry, hedge=on_chunk is None, deadline=deadline)
+
+
+def analyze_long_transcript_with_gemini(transcript, on_chunk=None, on_retry=None):
+    """Análise em partes: os segmentos são analisados em paralelo (map) e juntados numa chamada final (reduce).
+
+    Como os segmentos rodam em paralelo, o tempo da análise cresce pouco com o tamanho da transcrição.
+    Cada chamada (segmento ou junção) ocupa a sua própria vaga de GEMINI_CONCURRENCY,
+    e todas dividem o prazo de GEMINI_DEADLINE_SECONDS da análise.
+    """
+    deadline = gemini_caller.stage_deadline()
+    segments = split_transcript(transcript, ANALYSIS_SEGMENT_CHARS)
+    logger.info(f"Análise em partes: {len(segments)} segmentos.")
+    segment_model = get_gemini_model('segment')
+
+    def analyze_segment(index_and_segment):
+        index, segment = index_and_segment
+        with gemini_slots:
+            return generate_gemini_text(segment_model, build_segment_prompt(index, len(segments), segment),
+                                        on_retry=on_retry, deadline=deadline)
+
+    # map() preserva a ordem dos segmentos
+    segment_notes = list(analysis_map_executor.map(analyze_segment, enumerate(segments, start=1)))
+    reduce_model = get_gemini_model('reduce')
+    reduce_prompt = build_prompt_within_budget(reduce_model, build_reduce_prompt, segment_notes)
+    with gemini_slots:
+        return generate_gemini_text(reduce_model, reduce_prompt, on_chunk, on_retry, deadline)
+
+
+async def analyze_long_transcript_with_gemini_async(transcript, on_chunk=None, on_retry=None):
+    """Versão assíncrona de analyze_long_transcript_with_gemini."""
+    deadline = gemini_caller.stage_deadline()
+    segments = split_transcript(transcript, ANALYSIS_SEGMENT_CHARS)
+    logger.info(f"Análise em partes: {len(segments)} segmentos.")
+    segment_model = get_gemini_model('segment')
+
+    async def analyze_segment(index, segment):
+        async with async_map_slots, async_gemini_slots:
+            return await generate_gemini_text_async(segment_model, build_segment_prompt(index, len(segments), segment),
+                                                    on_retry=on_retry, deadline=deadline)
+
+    segment_notes = await asyncio.gather(*(analyze_segment(index, segment)
+                                           for index, segment in enumerate(segments, start=1)))
+    reduce_model = get_gemini_model('reduce')
+    # A contagem de tokens (perto do limite) é uma chamada síncrona: roda fora do event loop
+    reduce_prompt = await asyncio.to_thread(build_prompt_within_budget, reduce_model, build_reduce_prompt, segment_notes)
+    async with async_gemini_slots:
+        return await generate_gemini_text_async(reduce_model, reduce_prompt, on_chunk, on_retry, deadline)
+
+
+@contextmanager
+def gemini_errors():
+    """Contabiliza e padroniza os erros da análise (nas versões síncrona e assíncrona)."""
+    try:
+        yield
+    except Exception as e:
+        API_ERRORS.inc(api='gemini')
+        logger.error(f"Erro durante a análise com Gemini: {e}")
+        raise Exception(f"Erro na análise LLM: {e}") from e
+
+
+def analyze_transcript_with_gemini(transcript, on_chunk=None, on_retry=None):
+    """Analisa a transcrição usando a API Gemini do Google.
+
+    Se on_chunk for informado, a resposta é gerada em streaming e cada
+    fragmento de texto é repassado a on_chunk assim que chega. Transcrições
+    com mais de LONG_TRANSCRIPT_CHARS caracteres (ou acima de GEMINI_MAX_INPUT_TOKENS)
+    são analisadas em partes.
+    on_retry é chamado antes de cada nova tentativa (veja ResilientCaller).
+    """
     if not google_api_key:
         raise ValueError("Chave da API Google (Gemini) não configurada.")
 
-    print("Iniciando análise com Gemini...")
-    try:
-        # Escolhe o modelo Gemini
-        # Veja modelos disponíveis: https://ai.google.dev/models/gemini
-        model = genai.GenerativeModel('gemini-2.0-flash') # Ou 'gemini-2.5-pro-exp-03-25'
+    logger.info("Iniciando análise com Gemini...")
+    with gemini_errors():
+        if needs_long_analysis(transcript):
+            # Os segmentos e a junção ocupam cada um a sua vaga do Gemini
+            analysis_text = analyze_long_transcript_with_gemini(transcript, on_chunk, on_retry)
+        else:
+            # Respeita o limite de chamadas simultâneas ao Gemini
+            with gemini_slots:
+                # Modelo compartilhado, com as instruções da análise já configuradas
+                analysis_text = generate_gemini_text(get_gemini_model('analysis'), build_analysis_prompt(transcript),
+                                                     on_chunk, on_retry)
 
-        # Prompt detalhado para o LLM
-        prompt = f"""
-        Analise a seguinte transcrição de uma nota de voz pessoal, que representa um fluxo de consciência do usuário. Aja como um assistente reflexivo e útil. Sua análise deve ser estruturada em Markdown e incluir as seguintes seções:
+    logger.info("Análise Gemini concluída.")
+    # Adiciona uma nota ao final
+    return analysis_text + ANALYSIS_DISCLAIMER
 
-        1.  **Transcrição Original:** Inclua a transcrição completa fornecida abaixo.
-        2.  **Resumo dos Pontos Principais:** Identifique e liste os temas ou ideias centrais discutidos.
-        3.  **Problemas ou Desafios:** Liste quaisquer problemas, preocupações ou dificuldades expressas pelo usuário.
-        4.  **Conexões e Possíveis Causas:** Explore possíveis ligações entre os diferentes pontos ou problemas mencionados. Se possível, sugira causas subjacentes para os desafios identificados (apresente como hipóteses, não certezas).
-        5.  **Próximos Passos Acionáveis:** Sugira 3-5 passos concretos e práticos que o usuário poderia tomar para abordar os desafios, explorar as ideias ou ganhar clareza. Foque em ações pequenas e gerenciáveis.
 
-        Formate toda a resposta usando Markdown. Use cabeçalhos (##) para cada seção. Use listas de marcadores (*) ou numeradas (1.) conforme apropriado. Mantenha um tom empático e construtivo.
+async def analyze_transcript_with_gemini_async(transcript, on_chunk=None, on_retry=None):
+    """Versão assíncrona de analyze_transcript_with_gemini (generate_content_async)."""
+    if not google_api_key:
+        raise ValueError("Chave da API Google (Gemini) não configurada.")
 
-        **Transcrição para Análise:**
-        ---
-        {transcript}
-        ---
+    logger.info("Iniciando análise com Gemini...")
+    with gemini_errors():
+        if await asyncio.to_thread(needs_long_analysis, transcript):
+            analysis_text = await analyze_long_transcript_with_gemini_async(transcript, on_chunk, on_retry)
+        else:
+            async with async_gemini_slots:
+                analysis_text = await generate_gemini_text_async(get_gemini_model('analysis'),
+                                                                 build_analysis_prompt(transcript), on_chunk, on_retry)
 
-        **Análise Formatada em Markdown:**
-        """
+    logger.info("Análise Gemini concluída.")
+    return analysis_text + ANALYSIS_DISCLAIMER
+
+
+def summarize_analyses_with_gemini(analyses):
+    """Gera um resumo entre notas a partir das análises individuais de um lote."""
+    if not google_api_key:
+        raise ValueError("Chave da API Google (Gemini) não configurada.")
+
+    logger.info(f"Iniciando resumo combinado de {len(analyses)} notas com Gemini...")
+    try:
+        model = get_gemini_model('summary')
+        filenames = [filename for filename, _ in analyses]
+
+        def build_summary_prompt(texts):
+            notes = "\n\n".join(f"### Nota {index}: {filename}\n{analysis}"
+                                 for index, (filename, analysis) in enumerate(zip(filenames, texts), start=1))
+            return f"**Análises das Notas:**\n---\n{notes}\n---\n\n**Visão Geral em Markdown:**"
 
-        # Chama a API Gemini
-        response = model.generate_content(prompt)
+        prompt = build_prompt_within_budget(model, build_summary_prompt, [analysis for _, analysis in analyses])
 
-        print("Análise Gemini concluída.")
-        # A resposta geralmente está em response.text
-        # Adiciona uma nota ao final
-        analysis_text = response.text
-        analysis_text += "\n\n*Esta análise foi gerada por IA e destina-se a fins de reflexão. Não substitui aconselhamento profissional.*"
-        return analysis_text
+        summary = generate_gemini_text(model, prompt)
+        logger.info("Resumo combinado Gemini concluído.")
+        return summary
 
     except Exception as e:
-        print(f"Erro durante a análise com Gemini: {e}")
-        # Tenta extrair informações mais detalhadas do erro, se disponíveis
-        error_message = str(e)
-        # if hasattr(e, 'message'): # Alguns erros de API podem ter um atributo 'message'
-        #     error_message = e.message
-        raise Exception(f"Erro na análise LLM: {error_message}") from e
+        API_ERRORS.inc(api='gemini')
+        logger.error(f"Erro durante o resumo combinado com Gemini: {e}")
+        raise Exception(f"Erro no resumo combinado: {e}") from e
 
 
-def generate_markdown_file(analysis_content):
-    """Gera o conteúdo Markdown final (neste caso, já está formatado)."""
-    return analysis_content
+def generate_markdown_file(transcript, analysis_content):
+    """Gera o conteúdo Markdown final: a transcrição, montada aqui (o modelo não a repete), e a análise."""
+    return f"## Transcrição Original\n\n{transcript}\n\n{analysis_content}"
 
 # --- Função da Tarefa em Background ---
-def process_audio_task(task_id, audio_bytes, original_filename):
-    """Executa a transcrição e análise reais em uma thread separada."""
+# Etapas comuns aos dois motores de processamento (threads e asyncio)
+def begin_audio_task(task_id, audio_path):
+    """Marca a tarefa como iniciada e retorna a chave de cache do áudio (ou None)."""
+    rss_monitor.track(task_id)
+    update_task_status(task_id, 'processing', message='Iniciando transcrição...')
+    return file_content_hash(audio_path) if RESULT_CACHE_ENABLED else None
+
+
+def wait_notice(task_id, what):
+    """on_wait de wait_cached: mostra no status que a tarefa espera um cálculo idêntico."""
+    return lambda: update_task_status(task_id, 'processing', message=f'Aguardando {what}, já em andamento...')
+
+
+@contextmanager
+def cache_reservation(cache, key):
+    """Envolve o cálculo reservado por wait_cached: se ele falhar, libera quem o espera."""
+    try:
+        yield
+    except BaseException:
+        if key:
+            cache.abandon(key)
+        raise
+
+
+def retry_reporter(task_id, stage, reset_analysis=False):
+    """Callback de nova tentativa que mostra o motivo, a tentativa e o prazo no status da tarefa.
+
+    Com reset_analysis, avisa os clientes SSE para descartar o texto parcial da análise,
+    que recomeça na nova tentativa.
+    """
+    def report(attempt, max_attempts, delay, remaining, error):
+        if reset_analysis:
+            task_events.publish(task_id, 'analysis_reset')
+        logger.warning(f"Task {task_id}: {stage} falhou ({type(error).__name__}: {error}); "
+                       f"tentativa {attempt} de {max_attempts} em {delay:.1f}s.",
+                       extra={'task_id': task_id, 'stage': stage, 'attempt': attempt})
+        update_task_status(task_id, 'processing',
+                           message=f"{stage}: falha temporária ({type(error).__name__}). Tentativa {attempt} de "
+                                   f"{max_attempts} em {delay:.0f}s (prazo restante: {remaining:.0f}s)...")
+    return report
+
+
+def retry_reporter_async(task_id, stage, reset_analysis=False):
+    """Versão de retry_reporter para o motor asyncio: o status é atualizado fora do event loop."""
+    report = retry_reporter(task_id, stage, reset_analysis)
+
+    async def report_async(*args):
+        await asyncio.to_thread(report, *args)
+    return report_async
+
+
+def end_transcription_stage(task_id, transcript, start_time):
+    """Registra a duração da transcrição e anuncia a análise.
+
+    Retorna (duração da transcrição, chave de cache da transcrição ou None).
+    """
+    transcription_time = time.time() - start_time
+    logger.info(f"Task {task_id}: Transcrição levou {transcription_time:.2f}s",
+                extra={'task_id': task_id, 'stage': 'transcription', 'seconds': round(transcription_time, 3)})
+    update_task_status(task_id, 'processing', message=f'Transcrição concluída ({len(transcript)} caracteres). Analisando texto...')
+    return transcription_time, content_hash(transcript) if RESULT_CACHE_ENABLED else None
+
+
+def complete_audio_task(task_id, original_filename, transcript, analysis, start_time, transcription_time,
+                        batch_id=None):
+    """Registra a duração da análise, gera e armazena o relatório final e marca a tarefa como concluída."""
+    log_extra = {'task_id': task_id}
+    analysis_time = time.time() - start_time - transcription_time
+    logger.info(f"Task {task_id}: Análise levou {analysis_time:.2f}s",
+                extra=dict(log_extra, stage='analysis', seconds=round(analysis_time, 3)))
+    update_task_status(task_id, 'processing', message='Gerando relatório final...')
+    # 3. Gerar Markdown (transcrição + análise)
+    markdown_content = generate_markdown_file(transcript, analysis)
+
+    # 4. Armazenar resultado
+    result_id = task_id # Usar o mesmo ID
+    # Cria um nome de arquivo mais seguro
+    base_filename = os.path.splitext(original_filename)[0]
+    result_filename = f"analise_{secure_filename(base_filename)}.md"
+    store_result(result_id, markdown_content, result_filename)
+    if batch_id:
+        record_batch_analysis(batch_id, task_id, original_filename, transcript, analysis)
+
+    memory_stats = rss_monitor.finish(task_id)
+    update_task_status(task_id, 'completed', message='Processamento concluído!', result_id=result_id,
+                       extra=memory_stats)
+    total_time = time.time() - start_time
+    TASK_SECONDS.observe(total_time)
+    TASKS_FINISHED.inc(status='completed')
+    logger.info(f"Tarefa {task_id} concluída com sucesso em {total_time:.2f}s.",
+                extra=dict(log_extra, stage='total', seconds=round(total_time, 3), **(memory_stats or {})))
+
+
+def fail_audio_task(task_id, error):
+    """Marca a tarefa como falha, com uma mensagem conforme o tipo de erro."""
+    import openai
+    log_extra = {'task_id': task_id}
+    TASKS_FINISHED.inc(status='failed')
+    if isinstance(error, ValueError): # Erro de configuração (ex: chave API faltando)
+        logger.error(f"Erro de configuração na tarefa {task_id}: {error}", extra=log_extra)
+        update_task_status(task_id, 'failed', error=f"Erro de configuração: {error}")
+    elif isinstance(error.__cause__, CircuitOpenError): # API fora do ar: a tarefa falhou sem chamá-la
+        logger.error(f"Tarefa {task_id} interrompida: {error.__cause__}", extra=log_extra)
+        update_task_status(task_id, 'failed', error=f"Serviço temporariamente indisponível: {error.__cause__}")
+    elif isinstance(error, openai.APIError):
+        logger.error(f"Erro de API OpenAI na tarefa {task_id}: {error}", extra=log_extra)
+        update_task_status(task_id, 'failed', error=f"Erro na API de transcrição: {getattr(error, 'status_code', None)}")
+    else: # Outros erros (Gemini, etc.)
+        logger.error(f"Erro geral ao processar tarefa {task_id}: {error}", extra=log_extra)
+        update_task_status(task_id, 'failed', error=f"Erro no processamento: {error}")
+
+
+def end_audio_task(task_id, batch_id, *audio_paths):
+    """Libera os recursos da tarefa e, se ela for de um lote, tenta concluí-lo.
+
+    O áudio (original e pré-processado) só existe enquanto a tarefa está em andamento.
+    """
+    for path in set(audio_paths):
+        discard_spool_file(path)
+    rss_monitor.finish(task_id)
+    if batch_id:
+        finalize_batch_if_done(batch_id)
+
+
+def process_audio_task(task_id, audio_path, original_filename, batch_id=None):
+    """Executa a transcrição e análise reais em uma thread do pool de processamento.
+
+    audio_path é o arquivo temporário do upload, apagado ao final da tarefa.
+    Se batch_id for informado, a tarefa faz parte de um lote enviado em /batch.
+    """
     start_time = time.time()
+    log_extra = {'task_id': task_id}
+    whisper_path = audio_path
     try:
-        update_task_status(task_id, 'processing', message='Iniciando transcrição...')
-        # 1. Transcrever (Real)
-        transcript = transcribe_audio_with_whisper(audio_bytes, original_filename)
-        transcription_time = time.time() - start_time
-        print(f"Task {task_id}: Transcrição levou {transcription_time:.2f}s")
-
-        update_task_status(task_id, 'processing', message=f'Transcrição concluída ({len(transcript)} caracteres). Analisando texto...')
-        # 2. Analisar (Real)
-        analysis = analyze_transcript_with_gemini(transcript)
-        analysis_time = time.time() - start_time - transcription_time
-        print(f"Task {task_id}: Análise levou {analysis_time:.2f}s")
-
-
-        update_task_status(task_id, 'processing', message='Gerando relatório final...')
-        # 3. Gerar Markdown (já formatado pela análise)
-        markdown_content = generate_markdown_file(analysis)
-
-        # 4. Armazenar resultado
-        result_id = task_id # Usar o mesmo ID
-        # Cria um nome de arquivo mais seguro
-        base_filename = os.path.splitext(original_filename)[0]
-        result_filename = f"analise_{secure_filename(base_filename)}.md"
-        store_result(result_id, markdown_content, result_filename)
-
-        update_task_status(task_id, 'completed', message='Processamento concluído!', result_id=result_id)
-        total_time = time.time() - start_time
-        print(f"Tarefa {task_id} concluída com sucesso em {total_time:.2f}s.")
-
-    except ValueError as e: # Erro de configuração (ex: chave API faltando)
-        print(f"Erro de configuração na tarefa {task_id}: {e}")
-        update_task_status(task_id, 'failed', error=f"Erro de configuração: {e}")
-    except openai.APIError as e:
-        print(f"Erro de API OpenAI na tarefa {task_id}: {e}")
-        update_task_status(task_id, 'failed', error=f"Erro na API de transcrição: {e.status_code}")
-    except Exception as e: # Captura outros erros (Gemini, etc.)
-        print(f"Erro geral ao processar tarefa {task_id}: {e}")
-        update_task_status(task_id, 'failed', error=f"Erro no processamento: {e}")
+        # 1. Transcrever (Real), reaproveitando o cache quando o mesmo áudio já foi enviado
+        audio_key = begin_audio_task(task_id, audio_path)
+        # Um envio idêntico já em andamento é aguardado, em vez de transcrito de novo
+        transcript = wait_cached(transcript_cache, audio_key, wait_notice(task_id, 'a transcrição do mesmo áudio'))
+        if transcript is not None:
+            logger.info(f"Task {task_id}: Transcrição obtida do cache.", extra=log_extra)
+        else:
+            with cache_reservation(transcript_cache, audio_key):
+                # O pré-processamento usa CPU: roda antes de ocupar uma vaga do Whisper
+                whisper_path, whisper_filename = preprocess_audio(task_id, audio_path, original_filename)
+                # Respeita o limite de chamadas simultâneas ao Whisper
+                with whisper_slots:
+                    stage_start = time.perf_counter()
+                    transcript = transcribe_audio_with_whisper(whisper_path, whisper_filename,
+                                                               retry_reporter(task_id, 'Transcrição'))
+                    WHISPER_SECONDS.observe(time.perf_counter() - stage_start)
+            if audio_key:
+                transcript_cache.put(audio_key, transcript)
+        transcription_time, transcript_key = end_transcription_stage(task_id, transcript, start_time)
+
+        # 2. Analisar (Real), reaproveitando o cache quando a transcrição é idêntica
+        analysis = wait_cached(analysis_cache, transcript_key, wait_notice(task_id, 'a análise da mesma transcrição'))
+        if analysis is not None:
+            logger.info(f"Task {task_id}: Análise obtida do cache.", extra=log_extra)
+        else:
+            with cache_reservation(analysis_cache, transcript_key):
+                # O limite de chamadas simultâneas ao Gemini é aplicado a cada chamada, dentro da análise
+                stage_start = time.perf_counter()
+                # Os fragmentos da análise são enviados aos clientes SSE conforme chegam
+                analysis = analyze_transcript_with_gemini(
+                    transcript, on_chunk=lambda text: task_events.publish(task_id, 'analysis', {'text': text}),
+                    on_retry=retry_reporter(task_id, 'Análise', reset_analysis=True))
+                GEMINI_SECONDS.observe(time.perf_counter() - stage_start)
+            if transcript_key:
+                analysis_cache.put(transcript_key, analysis)
+
+        complete_audio_task(task_id, original_filename, transcript, analysis, start_time, transcription_time, batch_id)
+
+    except Exception as e:
+        fail_audio_task(task_id, e)
+    finally:
+        end_audio_task(task_id, batch_id, audio_path, whisper_path)
+
+
+async def process_audio_task_async(task_id, audio_path, original_filename, batch_id=None):
+    """Versão assíncrona de process_audio_task, executada no event loop do AsyncTaskEngine.
+
+    O event loop só aguarda as APIs: tudo que toca o armazenamento de estado (status,
+    resultado, lote combinado) ou o disco (hash e pré-processamento do áudio) roda em
+    threads auxiliares, para que um backend lento não trave as demais tarefas do loop.
+    """
+    start_time = time.time()
+    log_extra = {'task_id': task_id}
+    whisper_path = audio_path
+    try:
+        audio_key = await asyncio.to_thread(begin_audio_task, task_id, audio_path)
+        transcript = await wait_cached_async(transcript_cache, audio_key,
+                                             wait_notice(task_id, 'a transcrição do mesmo áudio'))
+        if transcript is not None:
+            logger.info(f"Task {task_id}: Transcrição obtida do cache.", extra=log_extra)
+        else:
+            with cache_reservation(transcript_cache, audio_key):
+                whisper_path, whisper_filename = await asyncio.to_thread(
+                    preprocess_audio, task_id, audio_path, original_filename)
+                async with async_whisper_slots:
+                    stage_start = time.perf_counter()
+                    transcript = await transcribe_audio_with_whisper_async(
+                        whisper_path, whisper_filename, retry_reporter_async(task_id, 'Transcrição'))
+                    WHISPER_SECONDS.observe(time.perf_counter() - stage_start)
+            if audio_key:
+                transcript_cache.put(audio_key, transcript)
+        transcription_time, transcript_key = await asyncio.to_thread(
+            end_transcription_stage, task_id, transcript, start_time)
+
+        analysis = await wait_cached_async(analysis_cache, transcript_key,
+                                           wait_notice(task_id, 'a análise da mesma transcrição'))
+        if analysis is not None:
+            logger.info(f"Task {task_id}: Análise obtida do cache.", extra=log_extra)
+        else:
+            with cache_reservation(analysis_cache, transcript_key):
+                stage_start = time.perf_counter()
+                analysis = await analyze_transcript_with_gemini_async(
+                    transcript, on_chunk=lambda text: task_events.publish(task_id, 'analysis', {'text': text}),
+                    on_retry=retry_reporter_async(task_id, 'Análise', reset_analysis=True))
+                GEMINI_SECONDS.observe(time.perf_counter() - stage_start)
+            if transcript_key:
+                analysis_cache.put(transcript_key, analysis)
+
+        await asyncio.to_thread(complete_audio_task, task_id, original_filename, transcript, analysis, start_time,
+                                transcription_time, batch_id)
+
+    except Exception as e:
+        await asyncio.to_thread(fail_audio_task, task_id, e)
+    finally:
+        # Inclui o resumo do lote combinado, que usa o cliente síncrono do Gemini
+        await asyncio.to_thread(end_audio_task, task_id, batch_id, audio_path, whisper_path)
+
+
+# Função de processamento usada pelos endpoints, conforme o motor configurado
+audio_task_handler = process_audio_task_async if ASYNC_ENGINE else process_audio_task
+
+
+# --- Lotes (Batch) ---
+# As tarefas de um lote são enfileiradas juntas no pool deste processo, então
+# a finalização pode ser coordenada com um lock local.
+batch_lock = threading.Lock()
+batch_analyses = {} # batch_id -> {task_id: (nome do arquivo, transcrição, análise)}, só enquanto o lote processa
+
+
+def record_batch_analysis(batch_id, task_id, original_filename, transcript, analysis):
+    """Guarda a transcrição e a análise de um arquivo do lote para o Markdown combinado."""
+    with batch_lock:
+        if batch_id in batch_analyses:
+            batch_analyses[batch_id][task_id] = (original_filename, transcript, analysis)
+
+
+def finalize_batch_if_done(batch_id):
+    """Conclui o lote quando todas as suas tarefas terminaram (chamada por cada tarefa)."""
+    with batch_lock:
+        batch = get_task_status(batch_id)
+        if not batch or batch['status'] != 'processing':
+            return
+        member_statuses = [get_task_status(task_id) for task_id in batch['task_ids']]
+        if any(member and member['status'] in ('pending', 'processing') for member in member_statuses):
+            return
+        # Esta tarefa é a última do lote: marca a finalização para que nenhuma outra a repita
+        update_task_status(batch_id, 'finalizing', message='Gerando relatório combinado...')
+        analyses = batch_analyses.pop(batch_id, {})
+
+    completed = sum(1 for member in member_statuses if member and member['status'] == 'completed')
+    if not completed:
+        update_task_status(batch_id, 'failed', error='Nenhum arquivo do lote foi processado com sucesso.')
+        return
+    if not batch.get('combine'):
+        update_task_status(batch_id, 'completed', message=f'{completed} de {len(member_statuses)} arquivos processados.')
+        return
+
+    # Mantém a ordem de envio dos arquivos
+    ordered = [analyses[task_id] for task_id in batch['task_ids'] if task_id in analyses]
+    try:
+        with gemini_slots:
+            # O resumo entre notas parte só das análises, sem as transcrições
+            summary = summarize_analyses_with_gemini([(filename, analysis) for filename, _, analysis in ordered])
+    except Exception as e:
+        # O relatório combinado ainda é útil sem o resumo entre notas
+        logger.warning(f"Lote {batch_id}: resumo combinado indisponível: {e}", extra={'batch_id': batch_id})
+        summary = "*Não foi possível gerar o resumo entre as notas.*"
+
+    sections = ["# Análise Combinada das Notas de Voz", "## Visão Geral entre as Notas", summary]
+    for index, (filename, transcript, analysis) in enumerate(ordered, start=1):
+        sections.extend(["---", f"# Nota {index}: {filename}", generate_markdown_file(transcript, analysis)])
+    store_result(batch_id, "\n\n".join(sections), "analise_combinada.md")
+    update_task_status(batch_id, 'completed', message=f'{completed} de {len(member_statuses)} arquivos processados.',
+                       result_id=batch_id)
+    logger.info(f"Lote {batch_id} concluído.")
+
+
+# --- Orçamento de Admissão (segundos de áudio) ---
+def audio_budget_limits(client_id):
+    """Limites do orçamento que se aplicam ao cliente, com seus identificadores no armazenamento."""
+    if not limiter.enabled:
+        return []
+    budgets = []
+    if audio_budget_per_client:
+        budgets.append((audio_budget_per_client, ('audio-seconds', 'client', client_id)))
+    if audio_budget_global:
+        budgets.append((audio_budget_global, ('audio-seconds', 'global')))
+    return budgets
+
+
+def check_audio_budget(client_id, audio_seconds):
+    """Verifica se há orçamento para audio_seconds, sem consumi-lo.
+
+    Retorna None se houver, ou a resposta de recusa (413 se o áudio sozinho
+    excede o orçamento, 429 com Retry-After se a janela atual está esgotada).
+    """
+    cost = max(1, math.ceil(audio_seconds))
+    for budget, identifiers in audio_budget_limits(client_id):
+        if cost > budget.amount:
+            return jsonify({"detail": f"O áudio (~{cost}s) excede o limite de processamento de {budget.amount}s de áudio "
+                                      f"por janela ({budget})."}), 413
+        if not limiter.limiter.test(budget, *identifiers, cost=cost):
+            reset_time = limiter.limiter.get_window_stats(budget, *identifiers).reset_time
+            retry_after = max(1, int(reset_time - time.time()))
+            response = jsonify({"detail": "Limite de processamento de áudio atingido. Tente novamente mais tarde.",
+                                "retry_after": retry_after})
+            response.headers['Retry-After'] = str(retry_after)
+            return response, 429
+    return None
+
+
+def charge_audio_budget(client_id, audio_seconds):
+    """Consome audio_seconds do orçamento (chamada depois que a tarefa entrou na fila)."""
+    cost = max(1, math.ceil(audio_seconds))
+    for budget, identifiers in audio_budget_limits(client_id):
+        limiter.limiter.hit(budget, *identifiers, cost=cost)
+
+
+# --- Inicialização por Processo ---
+# Nenhuma thread é criada na importação: com um master que pré-carrega o app e depois
+# faz fork (ex: gunicorn --preload), as threads do master não existiriam nos workers.
+services_lock = threading.Lock()
+services_pid = None # PID do processo em que os serviços foram iniciados
+
+
+def start_background_services():
+    """Inicia as threads de fundo deste processo (uma vez por processo, também após um fork).
+
+    Logs, limpeza do estado em memória (os backends compartilhados usam TTL),
+    manutenção de caches e arquivos temporários, pool de processamento e, com
+    API_WARMUP, o aquecimento das conexões com as APIs.
+    """
+    global services_pid
+    if services_pid == os.getpid():
+        return
+    with services_lock:
+        if services_pid == os.getpid():
+            return
+        log_listener.start()
+        state_store.start()
+        threading.Thread(target=run_maintenance, name="maintenance", daemon=True).start()
+        worker_pool.start()
+        if API_WARMUP:
+            threading.Thread(target=warm_up_api_clients, name="api-warmup", daemon=True).start()
+        services_pid = os.getpid()
+        logger.info(f"Serviços em background iniciados no processo {services_pid}.")
+
+
+@app.before_request
+def ensure_background_services():
+    """Garante os serviços no processo que atende a requisição (cada worker inicia os seus)."""
+    start_background_services()
+
+
+def create_app(start_services=False):
+    """Retorna o app pronto para servir.
+
+    Por padrão, os serviços em background sobem na primeira requisição de cada
+    processo, o que é seguro com fork. Com start_services=True, sobem já aqui
+    (servidor de um único processo, ou no hook post_fork do servidor).
+    """
+    if start_services:
+        start_background_services()
+    return app
+
+
+def upstream_unavailable_response():
+    """Resposta 503 enquanto o circuito de alguma API está aberto (None se todas estão disponíveis)."""
+    retry_after = math.ceil(upstream_retry_after())
+    if not retry_after:
+        return None
+    response = jsonify({"detail": "Serviço de transcrição/análise temporariamente indisponível. Tente novamente em instantes.",
+                        "retry_after": retry_after})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 503 # Service Unavailable
 
 
 # --- Endpoints da API (/, /upload, /status/<task_id>, /download/<result_id>) ---
@@ -320,9 +2048,9 @@ def index():
     """Serve a página HTML principal usando templates."""
     try:
         # O Flask procura automaticamente dentro da pasta 'templates'
-        return render_template("brain_dump.html")
+        return render_template("brain_dump.html", max_upload_mb=MAX_CONTENT_LENGTH // (1024*1024))
     except Exception as e:
-        print(f"Erro ao renderizar template: {e}")
+        logger.error(f"Erro ao renderizar template: {e}")
         # Retorna um erro genérico para o utilizador
         return "<html><body><h1>Erro Interno</h1><p>Não foi possível carregar a interface.</p></body></html>", 500
 
@@ -330,8 +2058,12 @@ def index():
 @limiter.limit("10 per hour") # Aplica o limite específico para este endpoint
 def upload_audio():
     """Recebe o arquivo de áudio (upload ou gravação direta), valida e inicia o processamento."""
-    if not openai.api_key or not google_api_key:
+    if not openai_api_key or not google_api_key:
         return jsonify({"detail": "Erro de configuração no servidor: APIs não inicializadas corretamente."}), 503 # Service Unavailable
+    # Falha rápido, antes de receber o áudio, se o Whisper ou o Gemini estão fora do ar
+    unavailable = upstream_unavailable_response()
+    if unavailable:
+        return unavailable
 
     # Verifica se é um upload de arquivo ou gravação direta
     try:
@@ -345,81 +2077,251 @@ def upload_audio():
             if not allowed_file(file.filename):
                 return jsonify({"detail": "Tipo de arquivo não permitido (use .wav ou .mp3)."}), 400
 
+            audio_path = None
             try:
-                audio_bytes = file.read() # Lê o conteúdo
                 original_filename = secure_filename(file.filename)
+                # Copia o upload em blocos para um arquivo temporário privado
+                fd, audio_path = create_spool_file(os.path.splitext(original_filename)[1])
+                with os.fdopen(fd, 'wb') as spool:
+                    shutil.copyfileobj(file.stream, spool, 1024 * 1024)
             except Exception as e:
-                print(f"Erro ao ler arquivo de áudio: {e}")
+                logger.error(f"Erro ao ler arquivo de áudio: {e}")
+                if audio_path:
+                    discard_spool_file(audio_path)
                 return jsonify({"detail": "Erro ao processar o arquivo de áudio."}), 400
                 
         elif 'audio_blob' in request.files:
             blob = request.files['audio_blob']
             
+            audio_path = None
             try:
-                # Converte o blob de áudio para WAV usando pydub
-                audio_bytes = blob.read()
-                audio_segment = AudioSegment.from_file(io.BytesIO(audio_bytes))
-                
-                # Exporta para WAV em memória
-                wav_output = io.BytesIO()
-                audio_segment.export(wav_output, format="wav")
-                audio_bytes = wav_output.getvalue()
-                original_filename = "recording.wav" # Nome padrão para áudios gravados
+                # Guarda a gravação como veio; a conversão é feita pelo worker (pré-processamento)
+                extension = RECORDING_EXTENSIONS.get(blob.mimetype, ".webm")
+                fd, audio_path = create_spool_file(extension)
+                with os.fdopen(fd, 'wb') as spool:
+                    shutil.copyfileobj(blob.stream, spool, 1024 * 1024)
+                original_filename = f"recording{extension}" # Nome padrão para áudios gravados
                 
             except Exception as e:
-                print(f"Erro na conversão de áudio: {e}")
+                logger.error(f"Erro na conversão de áudio: {e}")
+                if audio_path:
+                    discard_spool_file(audio_path)
                 return jsonify({"detail": "Erro ao processar a gravação de áudio."}), 400
                 
         else:
             return jsonify({"detail": "Nenhum arquivo de áudio ou gravação enviada."}), 400
             
     except Exception as e:
-        print(f"Erro ao processar requisição: {e}")
+        logger.error(f"Erro ao processar requisição: {e}")
         return jsonify({"detail": "Erro interno ao processar o upload."}), 500
 
     try:
-        if len(audio_bytes) > app.config['MAX_CONTENT_LENGTH']:
+        upload_size = os.path.getsize(audio_path)
+        UPLOAD_BYTES.observe(upload_size)
+        if upload_size > app.config['MAX_CONTENT_LENGTH']:
+            discard_spool_file(audio_path)
             return jsonify({"detail": f"Arquivo excede o limite de {MAX_CONTENT_LENGTH // (1024*1024)}MB."}), 413
 
-
-        # Gera um ID único para a tarefa
-        task_id = str(uuid.uuid4())
-
-        # Armazena o estado inicial da tarefa
-        with data_lock:
-            tasks[task_id] = {'status': 'pending', 'message': 'Tarefa recebida.', 'error': None, 'result_id': None, 'expires_at': None}
-
-        # Inicia a tarefa de processamento em uma nova thread
-        thread = threading.Thread(target=process_audio_task, args=(task_id, audio_bytes, original_filename))
-        thread.daemon = True # Permite que o programa saia mesmo se a thread estiver rodando
-        thread.start()
-
-        print(f"Tarefa {task_id} iniciada para o arquivo {original_filename}.")
+        # Admissão pelo custo real: a duração do áudio, e não o número de requisições
+        audio_seconds, rejection = measure_upload(audio_path, original_filename)
+        if rejection:
+            discard_spool_file(audio_path)
+            return rejection
+        client_id = get_remote_address()
+        # Teste e consumo do orçamento em sequência, para uploads simultâneos não passarem todos no teste
+        with audio_budget_lock:
+            rejection = check_audio_budget(client_id, audio_seconds)
+            if rejection:
+                discard_spool_file(audio_path)
+                logger.warning(f"Upload de {original_filename} (~{audio_seconds:.0f}s) recusado pelo orçamento de áudio.")
+                return rejection
+            AUDIO_DURATION_SECONDS.observe(audio_seconds)
+
+            # Gera um ID único para a tarefa
+            task_id = str(uuid.uuid4())
+
+            # Armazena o estado inicial da tarefa
+            state_store.create_task(task_id, {'status': 'pending', 'message': 'Tarefa recebida.', 'error': None, 'result_id': None})
+
+            # Enfileira a tarefa no pool de processamento (fila limitada)
+            if not worker_pool.submit(task_id, audio_task_handler, audio_path, original_filename):
+                state_store.delete_task(task_id)
+                discard_spool_file(audio_path)
+                retry_after = worker_pool.retry_after()
+                logger.warning(f"Fila de processamento cheia. Upload de {original_filename} recusado.")
+                response = jsonify({"detail": "Servidor ocupado: fila de processamento cheia. Tente novamente em instantes.",
+                                    "retry_after": retry_after})
+                response.headers['Retry-After'] = str(retry_after)
+                return response, 503 # Service Unavailable
+
+            charge_audio_budget(client_id, audio_seconds)
+        logger.info(f"Tarefa {task_id} enfileirada para o arquivo {original_filename}.")
         return jsonify({"task_id": task_id}), 202 # 202 Accepted: Requisição aceita, processamento iniciado
 
     except Exception as e:
         # Captura erros durante a leitura do arquivo ou início da thread
-        print(f"Erro crítico no upload: {e}")
+        logger.error(f"Erro crítico no upload: {e}")
+        discard_spool_file(audio_path)
         # Evita expor detalhes internos do erro ao cliente
         return jsonify({"detail": "Erro interno ao processar o upload."}), 500
 
 
-@app.route('/status/<task_id>', methods=['GET'])
-def get_analysis_status(task_id):
-    """Verifica o status de uma tarefa de análise."""
+@app.route('/batch', methods=['POST'])
+@limiter.limit("10 per hour") # Um lote consome um único slot do limite
+def upload_batch():
+    """Recebe vários arquivos de áudio ('audio_file') e os processa como um lote."""
+    if not openai_api_key or not google_api_key:
+        return jsonify({"detail": "Erro de configuração no servidor: APIs não inicializadas corretamente."}), 503 # Service Unavailable
+    unavailable = upstream_unavailable_response()
+    if unavailable:
+        return unavailable
+
+    # O limite de tamanho vale por arquivo; a requisição inteira pode ter até MAX_BATCH_FILES arquivos
+    request.max_content_length = MAX_CONTENT_LENGTH * MAX_BATCH_FILES
+    files = request.files.getlist('audio_file')
+    if not files:
+        return jsonify({"detail": "Nenhum arquivo de áudio enviado."}), 400
+    if len(files) > MAX_BATCH_FILES:
+        return jsonify({"detail": f"Envie no máximo {MAX_BATCH_FILES} arquivos por lote."}), 400
+    for file in files:
+        if file.filename == '' or not allowed_file(file.filename):
+            return jsonify({"detail": f"Arquivo inválido no lote: '{file.filename}' (use .wav ou .mp3)."}), 400
+
+    combine = request.form.get('combine', 'false').lower() == 'true'
+    batch_id = str(uuid.uuid4())
+    spooled = [] # (task_id, caminho, nome do arquivo)
+    try:
+        for file in files:
+            original_filename = secure_filename(file.filename)
+            fd, audio_path = create_spool_file(os.path.splitext(original_filename)[1])
+            spooled.append((str(uuid.uuid4()), audio_path, original_filename))
+            with os.fdopen(fd, 'wb') as spool:
+                shutil.copyfileobj(file.stream, spool, 1024 * 1024)
+            upload_size = os.path.getsize(audio_path)
+            UPLOAD_BYTES.observe(upload_size)
+            if upload_size > MAX_CONTENT_LENGTH:
+                for _, path, _ in spooled:
+                    discard_spool_file(path)
+                return jsonify({"detail": f"O arquivo '{original_filename}' excede o limite de {MAX_CONTENT_LENGTH // (1024*1024)}MB."}), 413
+
+        # O lote é cobrado pela soma das durações
+        durations = []
+        for _, path, name in spooled:
+            duration, rejection = measure_upload(path, name)
+            if rejection:
+                for _, spooled_path, _ in spooled:
+                    discard_spool_file(spooled_path)
+                return rejection
+            durations.append(duration)
+        audio_seconds = sum(durations)
+        client_id = get_remote_address()
+        # Teste e consumo do orçamento em sequência, para uploads simultâneos não passarem todos no teste
+        with audio_budget_lock:
+            rejection = check_audio_budget(client_id, audio_seconds)
+            if rejection:
+                for _, path, _ in spooled:
+                    discard_spool_file(path)
+                logger.warning(f"Lote com {len(spooled)} arquivos (~{audio_seconds:.0f}s) recusado pelo orçamento de áudio.")
+                return rejection
+            for duration in durations:
+                AUDIO_DURATION_SECONDS.observe(duration)
+
+            task_ids = [task_id for task_id, _, _ in spooled]
+            state_store.create_task(batch_id, {
+                'status': 'processing', 'message': 'Lote recebido.', 'error': None, 'result_id': None,
+                'kind': 'batch', 'task_ids': task_ids, 'filenames': [name for _, _, name in spooled], 'combine': combine,
+            })
+            for task_id, _, _ in spooled:
+                state_store.create_task(task_id, {'status': 'pending', 'message': 'Tarefa recebida.', 'error': None,
+                                                  'result_id': None, 'batch_id': batch_id})
+            if combine:
+                with batch_lock:
+                    batch_analyses[batch_id] = {}
+
+            # O lote inteiro entra na fila, ou nenhum arquivo entra
+            items = [(task_id, audio_task_handler, (path, name, batch_id)) for task_id, path, name in spooled]
+            if not worker_pool.submit_many(items):
+                for task_id, path, _ in spooled:
+                    state_store.delete_task(task_id)
+                    discard_spool_file(path)
+                state_store.delete_task(batch_id)
+                with batch_lock:
+                    batch_analyses.pop(batch_id, None)
+                retry_after = worker_pool.retry_after()
+                logger.warning(f"Fila de processamento cheia. Lote com {len(spooled)} arquivos recusado.")
+                response = jsonify({"detail": "Servidor ocupado: fila de processamento cheia. Tente novamente em instantes.",
+                                    "retry_after": retry_after})
+                response.headers['Retry-After'] = str(retry_after)
+                return response, 503 # Service Unavailable
+
+            charge_audio_budget(client_id, audio_seconds)
+        logger.info(f"Lote {batch_id} enfileirado com {len(spooled)} arquivos.")
+        return jsonify({"batch_id": batch_id, "task_ids": task_ids}), 202
+
+    except Exception as e:
+        logger.error(f"Erro crítico no upload do lote: {e}")
+        for _, path, _ in spooled:
+            discard_spool_file(path)
+        return jsonify({"detail": "Erro interno ao processar o lote."}), 500
+
+
+@app.route('/batch/<batch_id>', methods=['GET'])
+@limiter.exempt # Consultado repetidamente até o lote terminar; o envio já é limitado em /batch
+def get_batch_status(batch_id):
+    """Retorna o progresso agregado de um lote e o status de cada arquivo."""
+    batch = get_task_status(batch_id)
+    if not batch or batch.get('kind') != 'batch':
+        return jsonify({"detail": "Lote não encontrado ou expirado."}), 404
+
+    items = []
+    counts = {'completed': 0, 'failed': 0}
+    for task_id, filename in zip(batch['task_ids'], batch['filenames']):
+        task_status = build_status_response(task_id) or {'status': 'expired', 'message': 'Tarefa expirada.'}
+        if task_status['status'] in counts:
+            counts[task_status['status']] += 1
+        items.append(dict(task_status, task_id=task_id, filename=filename))
+
+    total = len(items)
+    response = {
+        "batch_id": batch_id,
+        "status": batch['status'],
+        "message": batch.get('message'),
+        "total": total,
+        "completed": counts['completed'],
+        "failed": counts['failed'],
+        "progress": round((counts['completed'] + counts['failed']) / total, 2) if total else 1.0,
+        "tasks": items,
+    }
+    if batch.get('error'):
+        response["error"] = batch['error']
+    if batch['status'] == 'completed' and batch.get('result_id'):
+        result_data = get_result(batch['result_id'])
+        if result_data:
+            response["download_url"] = f"/download/{batch['result_id']}"
+            time_left = result_data['created_at'] + timedelta(minutes=RESULT_EXPIRATION_MINUTES) - datetime.now(timezone.utc)
+            response["expires_in"] = max(0, int(time_left.total_seconds()))
+    return jsonify(response), 200
+
+
+def build_status_response(task_id):
+    """Monta o payload de status de uma tarefa (usado por /status e /events).
+
+    Retorna None se a tarefa não existe ou expirou.
+    """
     status_info = get_task_status(task_id) # Já retorna uma cópia segura
 
     if not status_info:
-        # Considera se a tarefa pode estar sendo processada mas ainda não foi registrada
-        # (pouco provável com a lógica atual, mas possível em sistemas mais complexos)
-        # Retorna 404 se definitivamente não existe
-        return jsonify({"detail": "Tarefa não encontrada ou expirada."}), 404
+        return None
 
-    response = {"status": status_info['status']}
+    response = {"status": status_info['status'], "version": status_info.get('version')}
     status = status_info['status']
 
     if status == 'completed':
         response["message"] = status_info.get('message', 'Concluído')
+        if status_info.get('peak_rss_mb') is not None:
+            # Memória observada durante a tarefa (para dimensionamento de instâncias)
+            response["peak_rss_mb"] = status_info['peak_rss_mb']
+            response["rss_delta_mb"] = status_info.get('rss_delta_mb')
         result_id = status_info.get('result_id')
         if result_id:
             # Verifica se o resultado ainda existe e não expirou antes de fornecer a URL
@@ -436,58 +2338,192 @@ def get_analysis_status(task_id):
                 response['message'] = 'O resultado expirou.'
                 # Atualizar o status da tarefa no backend para 'expired'
                 update_task_status(task_id, 'expired', message='Resultado expirado.')
+        elif status_info.get('kind') == 'batch':
+            # Lote sem relatório combinado: cada arquivo tem o seu download em /batch/<id>
+            response["batch_url"] = f"/batch/{task_id}"
         else:
             # Caso raro: status completed mas sem result_id
             response['status'] = 'failed'
             response['error'] = 'Erro interno: Concluído sem resultado associado.'
 
+    elif status == 'expired':
+        # Resultado vencido, ou removido antes do prazo pelo limite de memória
+        response["message"] = status_info.get('message', 'O resultado expirou.')
     elif status == 'failed':
         response["error"] = status_info.get('error', 'Falha desconhecida')
         response["message"] = status_info.get('message', 'Falha no processamento') # Mensagem pode ser útil
-    elif status == 'processing':
+    elif status in ('processing', 'finalizing'): # 'finalizing': lote gerando o relatório combinado
         response["message"] = status_info.get('message', 'Processando...')
     elif status == 'pending':
         response["message"] = status_info.get('message', 'Aguardando início do processamento...')
+        position = worker_pool.queue_position(task_id)
+        if position is not None:
+            expected_wait = worker_pool.estimated_wait(position)
+            response["queue_position"] = position
+            response["expected_wait"] = expected_wait
+            response["message"] = f"Na fila de processamento (posição {position}, espera estimada ~{expected_wait}s)."
+
     else: # Estado desconhecido
         response['status'] = 'unknown'
         response['message'] = 'Estado da tarefa desconhecido.'
 
+    return response
+
+
+@app.route('/status/<task_id>', methods=['GET'])
+@limiter.exempt # Consultado (ou em long-poll) até a tarefa terminar; o envio já é limitado em /upload
+def get_analysis_status(task_id):
+    """Verifica o status de uma tarefa de análise.
+
+    Com ?wait=N (long-poll), aguarda até N segundos (no máximo STATUS_MAX_WAIT_SECONDS)
+    por uma mudança de estado antes de responder. Em ?version= o cliente informa a
+    versão que já conhece; sem ela, a espera parte da versão atual.
+    """
+    wait = min(max(request.args.get('wait', 0, type=float), 0), STATUS_MAX_WAIT_SECONDS)
+    if wait:
+        status_info = get_task_status(task_id)
+        if status_info and status_info['status'] not in ('completed', 'failed', 'expired'):
+            known_version = request.args.get('version', status_info.get('version'), type=int)
+            if known_version == status_info.get('version'):
+                state_store.wait_for_task(task_id, known_version, wait)
+    response = build_status_response(task_id)
+
+    if response is None:
+        # Considera se a tarefa pode estar sendo processada mas ainda não foi registrada
+        # (pouco provável com a lógica atual, mas possível em sistemas mais complexos)
+        # Retorna 404 se definitivamente não existe
+        return jsonify({"detail": "Tarefa não encontrada ou expirada."}), 404
 
     return jsonify(response), 200
 
 
+def format_sse(event, data):
+    """Formata um evento no protocolo Server-Sent Events."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.route('/events/<task_id>', methods=['GET'])
+@limiter.exempt # O navegador reconecta sozinho quando a conexão SSE cai
+def stream_task_events(task_id):
+    """Envia as mudanças de status e os fragmentos da análise via Server-Sent Events."""
+    events, partial = task_events.subscribe(task_id)
+    initial_status = build_status_response(task_id)
+    if initial_status is None:
+        task_events.unsubscribe(task_id, events)
+        return jsonify({"detail": "Tarefa não encontrada ou expirada."}), 404
+
+    terminal_states = ('completed', 'failed', 'expired', 'unknown')
+    # Com estado compartilhado, a tarefa pode estar sendo processada em outro processo,
+    # cujos eventos não chegam aqui: nesse caso o status é revalidado a cada segundo
+    revalidate_seconds = 1 if state_store.shared else SSE_KEEPALIVE_SECONDS
+
+    def generate():
+        try:
+            last_status = initial_status
+            last_sent_at = time.monotonic()
+            yield format_sse('status', initial_status)
+            if initial_status['status'] in terminal_states:
+                return
+            if partial:
+                yield format_sse('analysis', {'text': partial})
+            while True:
+                try:
+                    event, data = events.get(timeout=revalidate_seconds)
+                except queue.Empty:
+                    # Revalida o status caso algum evento tenha sido descartado ou venha de outro processo
+                    status = build_status_response(task_id)
+                    if status is None:
+                        return
+                    if status != last_status:
+                        last_status = status
+                        last_sent_at = time.monotonic()
+                        yield format_sse('status', status)
+                        if status['status'] in terminal_states:
+                            return
+                    elif time.monotonic() - last_sent_at >= SSE_KEEPALIVE_SECONDS:
+                        last_sent_at = time.monotonic()
+                        yield ": keep-alive\n\n"
+                    continue
+
+                last_sent_at = time.monotonic()
+                if event == 'status':
+                    status = build_status_response(task_id)
+                    if status is None:
+                        return
+                    last_status = status
+                    yield format_sse('status', status)
+                    if status['status'] in terminal_states:
+                        return
+                else:
+                    yield format_sse(event, data)
+        finally:
+            task_events.unsubscribe(task_id, events)
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'} # Evita buffering em proxies (nginx)
+    return Response(generate(), mimetype='text/event-stream', headers=headers)
+
+
+@app.route('/metrics', methods=['GET'])
+@limiter.exempt # Coletado periodicamente pelo Prometheus
+def metrics():
+    """Expõe as métricas do processo no formato de texto do Prometheus."""
+    return Response(metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/cache/stats', methods=['GET'])
+@limiter.exempt # Coletado periodicamente pelo monitoramento, como /metrics
+def cache_stats():
+    """Expõe os contadores de acertos/falhas dos caches de transcrição e análise."""
+    return jsonify({
+        "enabled": RESULT_CACHE_ENABLED,
+        "ttl_seconds": int(RESULT_CACHE_TTL_MINUTES * 60),
+        "transcripts": transcript_cache.stats(),
+        "analyses": analysis_cache.stats(),
+    }), 200
+
+
 @app.route('/download/<result_id>', methods=['GET'])
 def download_result(result_id):
-    """Fornece o arquivo Markdown para download."""
+    """Fornece o arquivo Markdown para download.
+
+    Serve a variante comprimida aceita pelo cliente (Accept-Encoding), responde 304
+    a If-None-Match com o ETag atual e atende pedidos de intervalo (Range) sobre o
+    conteúdo original, útil para retomar downloads interrompidos.
+    """
     result_data = get_result(result_id) # get_result já lida com expiração
 
     if not result_data:
         # Abortar com 404 é apropriado para um recurso não encontrado
         abort(404, description="Resultado não encontrado ou expirado.")
 
-    markdown_content = result_data['content']
     # Usa um nome de arquivo padrão seguro se não estiver definido
-    filename = result_data.get('filename', 'analise_nota_voz.md')
+    filename = result_data.get('filename') or 'analise_nota_voz.md'
     # Garante que o nome do arquivo seja seguro para cabeçalhos HTTP
     safe_filename = secure_filename(filename)
 
-    # Cria um objeto BytesIO para enviar o conteúdo como arquivo
-    mem_file = io.BytesIO()
-    mem_file.write(markdown_content.encode('utf-8'))
-    mem_file.seek(0)
-
-    print(f"Servindo download para result_id: {result_id}, filename: {safe_filename}")
-
-    try:
-        return send_file(
-            mem_file,
-            as_attachment=True,
-            download_name=safe_filename, # Usa o nome seguro
-            mimetype='text/markdown; charset=utf-8' # Especifica charset
-        )
-    except Exception as e:
-        print(f"Erro ao enviar arquivo para download {result_id}: {e}")
-        abort(500, description="Erro ao gerar o arquivo para download.")
+    # Escolhe a representação: intervalos (Range) sempre usam o conteúdo original
+    encoding = None
+    if 'Range' not in request.headers:
+        available = [name for name in ('br', 'gzip') if result_data.get(name)]
+        if available:
+            encoding = request.accept_encodings.best_match(available)
+    body = result_data[encoding] if encoding else result_data['content']
+    etag = result_data.get('etag') or content_hash(result_data['content'])[:32]
+
+    response = Response(body, mimetype='text/markdown; charset=utf-8')
+    response.headers.set('Content-Disposition', 'attachment', filename=safe_filename)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'private, no-cache' # Sempre revalida (o resultado expira)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+        response.set_etag(f"{etag}-{encoding}") # Cada representação tem seu próprio ETag
+    else:
+        response.set_etag(etag)
+    response.last_modified = result_data['created_at']
+
+    logger.info(f"Servindo download para result_id: {result_id}, filename: {safe_filename}, encoding: {encoding or 'identity'}")
+    # Trata If-None-Match (304), Range (206/416) e If-Range
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(body))
 
 
 # --- Execução ---
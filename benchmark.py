@@ -0,0 +1,437 @@
+"""Benchmark offline do app, sem gastar créditos das APIs.
+
+Substitui `openai.audio.transcriptions.create`, `genai.GenerativeModel.generate_content` e `count_tokens`
+(e as versões assíncronas usadas com PROCESSING_ENGINE=asyncio) por versões locais com latência e taxa de falhas configuráveis e dispara uploads
+concorrentes, acompanhando cada tarefa por /status até o fim.
+
+Exemplo:
+    python benchmark.py --uploads 50 --clients 10 --whisper-latency 2 --gemini-latency 3
+
+Com --startup, mede apenas a inicialização: o tempo para importar o app num
+processo novo, a memória e as threads logo após a importação e após iniciar
+os serviços em background.
+
+As variáveis de ambiente do app (WORKER_THREADS, MAX_QUEUED_TASKS, ...) valem
+normalmente, então o mesmo cenário pode ser repetido antes e depois de uma mudança.
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import random
+import subprocess
+import statistics
+import sys
+import threading
+import time
+import wave
+
+# Chaves falsas: nenhuma chamada sai da máquina
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import httpx
+import openai
+import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from openai.resources.audio.transcriptions import AsyncTranscriptions, Transcriptions
+
+
+class LatencyModel:
+    """Latência log-normal definida pela mediana (s) e pela dispersão (sigma), mais uma taxa de falhas."""
+
+    def __init__(self, median, sigma, failure_rate, rng, seconds_per_kchar=0.0):
+        self.median = median
+        self.seconds_per_kchar = seconds_per_kchar # Custo adicional por mil caracteres de entrada
+        self.sigma = sigma
+        self.failure_rate = failure_rate
+        self.rng = rng
+        self.lock = threading.Lock() # random.Random não é seguro entre threads
+
+    def sample(self, input_chars=0):
+        """Retorna (latência em segundos, se a chamada deve falhar)."""
+        with self.lock:
+            if self.median <= 0:
+                latency = 0.0
+            else:
+                latency = self.rng.lognormvariate(math.log(self.median), self.sigma)
+            latency += self.seconds_per_kchar * input_chars / 1000
+            return latency, self.rng.random() < self.failure_rate
+
+
+class FakeGeminiChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeTokenCount:
+    def __init__(self, total_tokens):
+        self.total_tokens = total_tokens
+
+
+def install_fake_apis(whisper_model, gemini_model, transcript_chars=3000, stream_chunks=8):
+    """Troca as chamadas às APIs externas por simulações locais."""
+
+    body = "## Resumo dos Pontos Principais\n* Ponto simulado.\n" * 10
+    step = max(1, len(body) // stream_chunks)
+
+    def read_upload(file):
+        # Consome o arquivo como o cliente HTTP faria
+        filename, audio_file = file
+        size = 0
+        for block in iter(lambda: audio_file.read(64 * 1024), b""):
+            size += len(block)
+        sentence = "Pensamento solto sobre o dia. "
+        return f"Transcrição simulada de {filename} ({size} bytes). " + sentence * (transcript_chars // len(sentence))
+
+    def whisper_error():
+        return openai.APIConnectionError(request=httpx.Request("POST", "https://api.openai.com/v1/audio/transcriptions"))
+
+    def gemini_error():
+        return google_exceptions.ServiceUnavailable("Falha simulada do Gemini")
+
+    def fake_transcription(self, *, file, **kwargs):
+        latency, fail = whisper_model.sample()
+        text = read_upload(file)
+        time.sleep(latency)
+        if fail:
+            raise whisper_error()
+        return text
+
+    async def fake_transcription_async(self, *, file, **kwargs):
+        latency, fail = whisper_model.sample()
+        text = read_upload(file)
+        await asyncio.sleep(latency)
+        if fail:
+            raise whisper_error()
+        return text
+
+    def fake_generate_content(self, contents, *args, stream=False, **kwargs):
+        latency, fail = gemini_model.sample(len(str(contents)))
+        if not stream:
+            time.sleep(latency)
+            if fail:
+                raise gemini_error()
+            return FakeGeminiChunk(body)
+
+        def chunks():
+            # A latência é distribuída entre os fragmentos, como num streaming real
+            for start in range(0, len(body), step):
+                time.sleep(latency / stream_chunks)
+                if fail:
+                    raise gemini_error()
+                yield FakeGeminiChunk(body[start:start + step])
+        return chunks()
+
+    async def fake_generate_content_async(self, contents, *args, stream=False, **kwargs):
+        latency, fail = gemini_model.sample(len(str(contents)))
+        if not stream:
+            await asyncio.sleep(latency)
+            if fail:
+                raise gemini_error()
+            return FakeGeminiChunk(body)
+
+        async def chunks():
+            for start in range(0, len(body), step):
+                await asyncio.sleep(latency / stream_chunks)
+                if fail:
+                    raise gemini_error()
+                yield FakeGeminiChunk(body[start:start + step])
+        return chunks()
+
+    def fake_count_tokens(self, contents, *args, **kwargs):
+        return FakeTokenCount(len(str(contents)) // 4)
+
+    Transcriptions.create = fake_transcription
+    AsyncTranscriptions.create = fake_transcription_async
+    genai.GenerativeModel.generate_content = fake_generate_content
+    genai.GenerativeModel.generate_content_async = fake_generate_content_async
+    genai.GenerativeModel.count_tokens = fake_count_tokens
+
+
+def make_wav(seconds, sample_rate=16000):
+    """Gera um WAV mono de silêncio com a duração pedida."""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(b"\0\0" * int(seconds * sample_rate))
+    return buffer.getvalue()
+
+
+def percentile(values, fraction):
+    """Percentil pelo método do posto mais próximo (None se não houver valores)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[rank - 1]
+
+
+class ResourceSampler:
+    """Registra o pico de RSS e de threads do processo durante o benchmark."""
+
+    def __init__(self, rss_reader, interval_seconds=0.05):
+        self.rss_reader = rss_reader
+        self.interval_seconds = interval_seconds
+        self.peak_rss_bytes = 0
+        self.peak_threads = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True, name="bench-sampler")
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _loop(self):
+        while True:
+            self.peak_rss_bytes = max(self.peak_rss_bytes, self.rss_reader() or 0)
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            if self._stop.wait(self.interval_seconds):
+                break
+
+
+class LoadGenerator:
+    """Clientes concorrentes que enviam áudios e acompanham as tarefas por /status."""
+
+    def __init__(self, app, payload, uploads, clients, poll_interval, timeout, status_wait=0):
+        self.app = app
+        self.payload = payload
+        self.uploads = uploads
+        self.clients = clients
+        self.poll_interval = poll_interval
+        self.status_wait = status_wait # > 0: usa long-poll (/status?wait=N) em vez de consultas periódicas
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.next_upload = 0
+        self.latencies = []
+        self.outcomes = {"completed": 0, "failed": 0, "timeout": 0, "error": 0}
+        self.http_requests = 0
+        self.rejections = 0
+
+    def run(self):
+        threads = [threading.Thread(target=self._client_loop, name=f"bench-client-{index}")
+                   for index in range(self.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _claim_upload(self):
+        with self.lock:
+            if self.next_upload >= self.uploads:
+                return None
+            self.next_upload += 1
+            return self.next_upload
+
+    def _count(self, requests=0, rejections=0):
+        with self.lock:
+            self.http_requests += requests
+            self.rejections += rejections
+
+    def _client_loop(self):
+        client = self.app.test_client()
+        while (number := self._claim_upload()) is not None:
+            outcome, latency = self._run_one(client, number)
+            with self.lock:
+                self.outcomes[outcome] += 1
+                if outcome in ("completed", "failed"):
+                    self.latencies.append(latency)
+
+    def _run_one(self, client, number):
+        start = time.perf_counter()
+        deadline = start + self.timeout
+        # Envia o áudio; com a fila cheia (503), espera o Retry-After e tenta de novo
+        while True:
+            response = client.post("/upload", data={"audio_file": (io.BytesIO(self.payload), f"nota-{number}.wav")},
+                                   content_type="multipart/form-data")
+            self._count(requests=1)
+            if response.status_code == 202:
+                task_id = response.get_json()["task_id"]
+                break
+            if response.status_code != 503 or time.perf_counter() > deadline:
+                return "error", None
+            self._count(rejections=1)
+            time.sleep(min(float(response.headers.get("Retry-After", 1)), 1.0))
+        # Acompanha a tarefa até o fim
+        version = None
+        while time.perf_counter() < deadline:
+            if self.status_wait:
+                query = f"?wait={self.status_wait}" + (f"&version={version}" if version is not None else "")
+            else:
+                time.sleep(self.poll_interval)
+                query = ""
+            response = client.get(f"/status/{task_id}{query}")
+            self._count(requests=1)
+            payload = response.get_json()
+            status, version = payload.get("status"), payload.get("version")
+            if status in ("completed", "failed"):
+                return status, time.perf_counter() - start
+        return "timeout", None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline (APIs simuladas) do Brain Dump App.")
+    parser.add_argument("--uploads", type=int, default=40, help="total de áudios enviados")
+    parser.add_argument("--clients", type=int, default=8, help="clientes concorrentes")
+    parser.add_argument("--audio-seconds", type=float, default=30, help="duração do WAV enviado")
+    parser.add_argument("--transcript-chars", type=int, default=3000, help="tamanho da transcrição simulada")
+    parser.add_argument("--whisper-latency", type=float, default=1.0, help="mediana da latência do Whisper (s)")
+    parser.add_argument("--whisper-sigma", type=float, default=0.3, help="dispersão log-normal do Whisper")
+    parser.add_argument("--whisper-failure-rate", type=float, default=0.0, help="fração de chamadas ao Whisper que falham")
+    parser.add_argument("--gemini-latency", type=float, default=1.5, help="mediana da latência do Gemini (s)")
+    parser.add_argument("--gemini-sigma", type=float, default=0.3, help="dispersão log-normal do Gemini")
+    parser.add_argument("--gemini-seconds-per-kchar", type=float, default=0.0,
+                        help="latência adicional do Gemini por mil caracteres do prompt (s)")
+    parser.add_argument("--gemini-failure-rate", type=float, default=0.0, help="fração de chamadas ao Gemini que falham")
+    parser.add_argument("--poll-interval", type=float, default=0.2, help="intervalo entre consultas a /status (s)")
+    parser.add_argument("--status-wait", type=float, default=0,
+                        help="usa long-poll em /status com esta espera (s) em vez de --poll-interval")
+    parser.add_argument("--timeout", type=float, default=600, help="tempo máximo por tarefa (s)")
+    parser.add_argument("--seed", type=int, default=1, help="semente das latências simuladas")
+    parser.add_argument("--json", action="store_true", help="imprime o relatório em JSON")
+    parser.add_argument("--startup", action="store_true",
+                        help="mede só a inicialização (importação do app) em processos novos")
+    parser.add_argument("--startup-runs", type=int, default=5, help="processos medidos com --startup")
+    return parser.parse_args(argv)
+
+
+# Executado num processo novo: importa o app e mede o custo da importação
+STARTUP_PROBE = """
+import json, sys, threading, time
+start = time.perf_counter()
+import app
+import_seconds = time.perf_counter() - start
+report = {
+    "import_seconds": import_seconds,
+    "import_rss_bytes": app.current_rss_bytes(),
+    "import_threads": threading.active_count(),
+    "sdks_loaded": [name for name in ("openai", "google.generativeai", "pydub") if name in sys.modules],
+}
+start = time.perf_counter()
+app.create_app(start_services=True)
+report["services_seconds"] = time.perf_counter() - start
+report["services_rss_bytes"] = app.current_rss_bytes()
+report["services_threads"] = threading.active_count()
+print(json.dumps(report))
+"""
+
+
+def run_startup_benchmark(args):
+    """Importa o app em processos novos (sem cache de módulos) e resume as medições."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for _ in range(max(1, args.startup_runs)):
+        output = subprocess.run([sys.executable, "-c", STARTUP_PROBE], cwd=here, env=os.environ.copy(),
+                                capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    def median(key, scale=1):
+        values = [run[key] for run in runs if run[key] is not None]
+        return round(statistics.median(values) / scale, 3) if values else None
+
+    return {
+        "runs": len(runs),
+        "import_seconds": median("import_seconds"),
+        "import_rss_mb": median("import_rss_bytes", 1024 * 1024),
+        "import_threads": max(run["import_threads"] for run in runs),
+        "sdks_loaded_at_import": runs[0]["sdks_loaded"],
+        "services_seconds": median("services_seconds"),
+        "services_rss_mb": median("services_rss_bytes", 1024 * 1024),
+        "services_threads": max(run["services_threads"] for run in runs),
+    }
+
+
+def print_startup_report(report):
+    print(f"Inicialização ({report['runs']} processos, mediana):")
+    print(f"Importação do app: {report['import_seconds']}s, {report['import_rss_mb']}MB, "
+          f"{report['import_threads']} threads")
+    print("SDKs carregados na importação: " + (", ".join(report["sdks_loaded_at_import"]) or "nenhum"))
+    print(f"Serviços em background: {report['services_seconds']}s, {report['services_rss_mb']}MB, "
+          f"{report['services_threads']} threads")
+
+
+def run_benchmark(args):
+    rng = random.Random(args.seed)
+    install_fake_apis(LatencyModel(args.whisper_latency, args.whisper_sigma, args.whisper_failure_rate, rng),
+                      LatencyModel(args.gemini_latency, args.gemini_sigma, args.gemini_failure_rate, rng,
+                                   args.gemini_seconds_per_kchar),
+                      transcript_chars=args.transcript_chars)
+
+    import app as braindump # Importado após as chaves falsas estarem no ambiente
+    braindump.limiter.enabled = False # O benchmark mede o pipeline, não o limite por IP
+
+    generator = LoadGenerator(braindump.app, make_wav(args.audio_seconds), args.uploads, args.clients,
+                              args.poll_interval, args.timeout, args.status_wait)
+    sampler = ResourceSampler(braindump.current_rss_bytes)
+    sampler.start()
+    start = time.perf_counter()
+    generator.run()
+    elapsed = time.perf_counter() - start
+    sampler.stop()
+
+    latencies = generator.latencies
+    finished = generator.outcomes["completed"] + generator.outcomes["failed"]
+    return {
+        "uploads": args.uploads,
+        "clients": args.clients,
+        "engine": braindump.PROCESSING_ENGINE,
+        "workers": braindump.worker_pool.num_workers,
+        "elapsed_seconds": round(elapsed, 3),
+        "outcomes": generator.outcomes,
+        "rejections_503": generator.rejections,
+        "tasks_per_second": round(finished / elapsed, 3) if elapsed else None,
+        "requests_per_second": round(generator.http_requests / elapsed, 3) if elapsed else None,
+        "latency_seconds": {
+            name: (round(value, 3) if value is not None else None)
+            for name, value in (("p50", percentile(latencies, 0.50)),
+                                ("p95", percentile(latencies, 0.95)),
+                                ("p99", percentile(latencies, 0.99)))
+        },
+        "peak_rss_mb": round(sampler.peak_rss_bytes / (1024 * 1024), 1),
+        "peak_threads": sampler.peak_threads,
+    }
+
+
+def print_report(report):
+    latency = report["latency_seconds"]
+    print(f"Uploads: {report['uploads']} com {report['clients']} clientes "
+          f"(motor {report['engine']}, {report['workers']} workers)")
+    print(f"Duração: {report['elapsed_seconds']}s")
+    print("Resultados: " + ", ".join(f"{name}={count}" for name, count in report["outcomes"].items())
+          + f", recusas 503={report['rejections_503']}")
+    print(f"Vazão: {report['tasks_per_second']} tarefas/s, {report['requests_per_second']} requisições/s")
+    print(f"Latência ponta a ponta: p50={latency['p50']}s p95={latency['p95']}s p99={latency['p99']}s")
+    print(f"Pico de memória: {report['peak_rss_mb']}MB, pico de threads: {report['peak_threads']}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.startup:
+        report = run_startup_benchmark(args)
+        if args.json:
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            print_startup_report(report)
+        return
+    report = run_benchmark(args)
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report)
+    # Não espera as threads de fundo do app (limpeza, workers) ao sair
+    sys.stdout.flush()
+    os._exit(0 if report["outcomes"]["error"] == 0 else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+"""Controle de latência e de falhas nas chamadas às APIs externas.
+
+Cada chamada tem um prazo total, novas tentativas com backoff exponencial e
+jitter para erros temporários, uma requisição duplicada opcional (hedging)
+quando a primeira passa do percentil observado, e um circuit breaker que
+falha rápido enquanto a API está fora do ar. Sem dependências externas.
+"""
+import asyncio
+import inspect
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class CircuitOpenError(Exception):
+    """A API está marcada como indisponível; a chamada nem é feita."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} indisponível no momento (nova tentativa em {retry_after:.0f}s)")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(TimeoutError):
+    """O prazo total da chamada (somando as tentativas) acabou."""
+
+
+class CircuitBreaker:
+    """Abre após failure_threshold falhas seguidas e fica aberto por reset_seconds.
+
+    Depois desse tempo, fica meio-aberto: uma única chamada de teste passa e,
+    conforme o resultado, o circuito fecha ou abre de novo.
+    """
+
+    def __init__(self, name, failure_threshold, reset_seconds):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def retry_after(self):
+        """Segundos até o circuito aceitar chamadas de novo (0 se estiver fechado ou meio-aberto)."""
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            return max(0.0, self._opened_at + self.reset_seconds - time.monotonic())
+
+    @property
+    def is_open(self):
+        return self.retry_after() > 0
+
+    def allow(self):
+        """Levanta CircuitOpenError se a chamada não deve ser feita agora.
+
+        Retorna True se a chamada é o teste do circuito meio-aberto.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            remaining = self._opened_at + self.reset_seconds - time.monotonic()
+            if remaining > 0:
+                raise CircuitOpenError(self.name, remaining)
+            if self._trial_in_flight:
+                raise CircuitOpenError(self.name, 1)
+            self._trial_in_flight = True # Meio-aberto: só esta chamada testa a API
+            return True
+
+    def release_trial(self):
+        """Libera o teste do meio-aberto sem registrar resultado (tentativa interrompida)."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        """Registra uma falha. Retorna True se o circuito abriu com ela."""
+        with self._lock:
+            self._failures += 1
+            reopened = self._trial_in_flight
+            self._trial_in_flight = False
+            if reopened or (self._opened_at is None and self._failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                return True
+            return False
+
+
+class LatencyTracker:
+    """Latências das últimas chamadas bem-sucedidas, para calcular percentis."""
+
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, quantile, min_samples):
+        """Percentil das amostras, ou None se ainda não houver min_samples."""
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+
+
+class ResilientCaller:
+    """Executa chamadas a uma API com prazo, novas tentativas, hedging e circuit breaker.
+
+    A função de tentativa recebe o tempo máximo daquela tentativa (em segundos)
+    e deve repassá-lo ao cliente HTTP. Ela pode ser executada mais de uma vez,
+    inclusive ao mesmo tempo (hedging), então não deve reaproveitar arquivos abertos.
+    on_retry(tentativa, total, espera, prazo restante, erro) é chamado antes de cada nova tentativa;
+    em call_async, ele pode ser uma corrotina, aguardada antes da espera.
+    on_event('retry' | 'hedge' | 'circuit_open') serve para métricas.
+    Por padrão, cada chamada tem o seu prazo de deadline_seconds; para que várias
+    chamadas de um mesmo estágio (ex: trechos de um áudio) dividam um único prazo,
+    passe a todas o mesmo deadline, obtido de stage_deadline().
+    """
+
+    def __init__(self, name, deadline_seconds, attempt_timeout, max_attempts, backoff_base, backoff_max,
+                 is_retryable, breaker, hedging=False, hedge_quantile=0.95, hedge_min_samples=20,
+                 hedge_max_workers=32, on_event=None):
+        self.name = name
+        self.deadline_seconds = deadline_seconds
+        self.attempt_timeout = attempt_timeout
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.is_retryable = is_retryable
+        self.breaker = breaker
+        self.hedging = hedging
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_max_workers = hedge_max_workers
+        self.latency = LatencyTracker()
+        self._on_event = on_event
+        self._executor = None # Criado na primeira requisição duplicada
+        self._executor_lock = threading.Lock()
+
+    def _notify(self, event):
+        if self._on_event:
+            self._on_event(event)
+
+    def hedge_delay(self):
+        """Tempo após o qual uma requisição duplicada é disparada (None se o hedging não se aplica)."""
+        if not self.hedging:
+            return None
+        return self.latency.percentile(self.hedge_quantile, self.hedge_min_samples)
+
+    def backoff(self, attempt):
+        """Espera antes da tentativa seguinte: exponencial com jitter completo."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    def _record_failure(self, error):
+        if not self.is_retryable(error):
+            # A API respondeu (ex: requisição inválida): não indica que ela está fora do ar
+            self.breaker.record_success()
+            return False
+        if self.breaker.record_failure():
+            self._notify('circuit_open')
+        return True
+
+    def _next_delay(self, attempt, deadline):
+        """(espera, prazo restante) até a próxima tentativa, ou None se não houver outra (levanta o erro)."""
+        if attempt >= self.max_attempts:
+            return None
+        delay = self.backoff(attempt)
+        remaining = deadline - time.monotonic() - delay
+        if remaining <= 0:
+            return None
+        self._notify('retry')
+        return delay, remaining
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.hedge_max_workers,
+                                                    thread_name_prefix=f"{self.name}-hedge")
+            return self._executor
+
+    def stage_deadline(self):
+        """Prazo (em time.monotonic) de um estágio que começa agora."""
+        return time.monotonic() + self.deadline_seconds
+
+    def _attempt_timeout(self, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"{self.name}: prazo de {self.deadline_seconds:.0f}s esgotado")
+        return min(self.attempt_timeout, remaining)
+
+    def call(self, attempt, on_retry=None, hedge=True, deadline=None):
+        """Executa attempt(timeout) com as políticas configuradas e retorna o resultado."""
+        if deadline is None:
+            deadline = self.stage_deadline()
+        for attempt_number in range(1, self.max_attempts + 1):
+            timeout = self._attempt_timeout(deadline)
+            is_trial = self.breaker.allow()
+            start = time.monotonic()
+            try:
+                result = self._run_hedged(attempt, timeout, deadline) if hedge else attempt(timeout)
+            except Exception as e:
+                if not self._record_failure(e):
+                    raise
+                retry = self._next_delay(attempt_number, deadline)
+                if retry is None:
+                    raise
+                error = e
+            else:
+                self.breaker.record_success()
+                self.latency.observe(time.monotonic() - start)
+                return result
+            finally:
+                if is_trial:
+                    self.breaker.release_trial()
+            delay, remaining = retry
+            if on_retry:
+                on_retry(attempt_number + 1, self.max_attempts, delay, remaining, error)
+            time.sleep(delay)
+
+    def _run_hedged(self, attempt, timeout, deadline):
+        hedge_delay = self.hedge_delay()
+        if hedge_delay is None or hedge_delay >= timeout:
+            return attempt(timeout)
+        executor = self._get_executor()
+        primary = executor.submit(attempt, timeout)
+        done, _ = wait([primary], timeout=hedge_delay)
+        if done:
+            return primary.result()
+        # A primeira requisição passou do percentil: dispara uma cópia e fica com a que terminar antes.
+        # A perdedora não pode ser interrompida e termina em background, com o resultado descartado.
+        self._notify('hedge')
+        secondary = executor.submit(attempt, self._attempt_timeout(deadline))
+        pending = {primary, secondary}
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                raise DeadlineExceeded(f"{self.name}: prazo de {self.deadline_seconds:.0f}s esgotado")
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def call_async(self, attempt, on_retry=None, hedge=True, deadline=None):
+        """Versão assíncrona de call: attempt(timeout) retorna uma corrotina."""
+        if deadline is None:
+            deadline = self.stage_deadline()
+        for attempt_number in range(1, self.max_attempts + 1):
+            timeout = self._attempt_timeout(deadline)
+            is_trial = self.breaker.allow()
+            start = time.monotonic()
+            try:
+                if hedge:
+                    result = await self._run_hedged_async(attempt, timeout, deadline)
+                else:
+                    result = await asyncio.wait_for(attempt(timeout), timeout)
+            except Exception as e:
+                if not self._record_failure(e):
+                    raise
+                retry = self._next_delay(attempt_number, deadline)
+                if retry is None:
+                    raise
+                error = e
+            else:
+                self.breaker.record_success()
+                self.latency.observe(time.monotonic() - start)
+                return result
+            finally:
+                # Uma tentativa interrompida (ex: CancelledError) não registra sucesso nem
+                # falha: sem isso, o circuito meio-aberto ficaria preso esperando o teste
+                if is_trial:
+                    self.breaker.release_trial()
+            delay, remaining = retry
+            if on_retry:
+                notice = on_retry(attempt_number + 1, self.max_attempts, delay, remaining, error)
+                if inspect.isawaitable(notice):
+                    await notice
+            await asyncio.sleep(delay)
+
+    async def _run_hedged_async(self, attempt, timeout, deadline):
+        # No event loop, o prazo de cada tentativa é garantido por wait_for, e a perdedora é cancelada
+        primary = asyncio.ensure_future(asyncio.wait_for(attempt(timeout), timeout))
+        pending = {primary}
+        try:
+            hedge_delay = self.hedge_delay()
+            if hedge_delay is None or hedge_delay >= timeout:
+                return await primary
+            done, pending = await asyncio.wait(pending, timeout=hedge_delay)
+            if done:
+                return primary.result()
+            self._notify('hedge')
+            secondary_timeout = self._attempt_timeout(deadline)
+            pending.add(asyncio.ensure_future(asyncio.wait_for(attempt(secondary_timeout), secondary_timeout)))
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,619 @@
+"""Backends de armazenamento do estado compartilhado (tarefas e resultados).
+
+O app usa apenas a interface de StateStore, de modo que o estado pode ficar na
+memória do processo (padrão, um único worker) ou num armazenamento comum a
+vários processos (SQLite em modo WAL ou um servidor compatível com Redis).
+"""
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+logger = logging.getLogger("braindump.storage")
+
+
+class StateStore:
+    """Interface dos backends de estado.
+
+    Tarefas e resultados são dicionários simples. Os prazos de expiração são
+    datetimes em UTC; cada backend decide como aplicá-los. Cada tarefa tem um
+    campo 'version', incrementado a cada atualização.
+
+    Um resultado tem 'content' (bytes UTF-8), 'etag', 'filename', 'created_at'
+    e, opcionalmente, variantes já comprimidas em RESULT_ENCODINGS.
+    """
+
+    # Variantes comprimidas que um resultado pode guardar, além do conteúdo original
+    RESULT_ENCODINGS = ('gzip', 'br')
+
+    # True quando outros processos podem alterar o estado (ex: SQLite, Redis)
+    shared = False
+
+    # Intervalo entre consultas de wait_for_task nos backends sem notificação
+    wait_poll_seconds = 0.5
+
+    def start(self):
+        """Inicia serviços em background do backend (se houver)."""
+
+    def create_task(self, task_id, task):
+        raise NotImplementedError
+
+    def get_task(self, task_id):
+        """Retorna uma cópia da tarefa ou None."""
+        raise NotImplementedError
+
+    def update_task(self, task_id, fields, expires_at=None):
+        """Atualiza campos da tarefa. Retorna False se a tarefa não existe."""
+        raise NotImplementedError
+
+    def delete_task(self, task_id):
+        raise NotImplementedError
+
+    def store_result(self, result_id, result, expires_at):
+        raise NotImplementedError
+
+    def get_result(self, result_id):
+        """Retorna uma cópia do resultado, ou None se não existe ou expirou."""
+        raise NotImplementedError
+
+    def wait_for_task(self, task_id, version, timeout):
+        """Aguarda até timeout segundos a tarefa sair da versão informada.
+
+        Retorna a tarefa atual (ou None se ela não existe mais). Por padrão
+        consulta o backend periodicamente; o backend em memória é notificado.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            task = self.get_task(task_id)
+            remaining = deadline - time.monotonic()
+            if task is None or task.get('version') != version or remaining <= 0:
+                return task
+            time.sleep(min(self.wait_poll_seconds, remaining))
+
+
+class TaskRecord:
+    """Registro compacto de uma tarefa no backend em memória.
+
+    Os campos usados por todas as tarefas ficam em slots; os demais (ex: dados
+    de lote, memória da tarefa) em 'extra'. 'changed' é a condição criada sob
+    demanda para quem aguarda mudanças (long-poll), sobre o lock da faixa.
+    """
+
+    __slots__ = ('status', 'message', 'error', 'result_id', 'expires_at', 'version', 'extra', 'changed')
+
+    FIELDS = ('status', 'message', 'error', 'result_id')
+
+    def __init__(self, fields):
+        self.status = self.message = self.error = self.result_id = None
+        self.expires_at = None
+        self.version = 0
+        self.extra = None
+        self.changed = None
+        self.update(fields)
+
+    def update(self, fields):
+        for name, value in fields.items():
+            if name in self.FIELDS:
+                setattr(self, name, value)
+            elif name != 'version':
+                if self.extra is None:
+                    self.extra = {}
+                self.extra[name] = value
+
+    def as_dict(self):
+        data = {name: getattr(self, name) for name in self.FIELDS}
+        if self.extra:
+            data.update(self.extra)
+        if self.expires_at is not None:
+            data['expires_at'] = self.expires_at
+        data['version'] = self.version
+        return data
+
+
+class MemoryStateStore(StateStore):
+    """Estado em memória do processo, com locks por faixa e índice de expiração.
+
+    Tarefas e resultados são protegidos por lock striping: cada id cai numa de
+    num_stripes faixas, cada uma com seu lock, então /status, uploads e
+    workers de tarefas diferentes raramente disputam o mesmo lock. As
+    operações isoladas nos dicionários são atômicas no CPython; os locks
+    protegem a leitura e a alteração de cada registro.
+
+    O índice de expiração é um min-heap de (expira_em, tipo, id), com tipo
+    'task' ou 'result', com lock próprio. Entradas obsoletas (item já removido
+    ou com nova expiração) são descartadas ao sair do heap. Uma thread de
+    limpeza dorme até o próximo prazo, então os itens saem da memória perto
+    do vencimento.
+
+    Com max_result_bytes, a soma dos bytes dos resultados é limitada: ao
+    passar do limite, os resultados mais antigos saem antes do prazo.
+    """
+
+    def __init__(self, lock_wait_observer=None, num_stripes=64, max_result_bytes=None):
+        self.tasks = {} # task_id -> TaskRecord
+        self.results = {}
+        self.max_result_bytes = max_result_bytes
+        self._result_sizes = OrderedDict() # result_id -> bytes, do mais antigo ao mais novo
+        self._result_bytes = 0
+        self._result_sizes_lock = threading.Lock()
+        self._stripes = [threading.Lock() for _ in range(num_stripes)]
+        self._lock_wait_observer = lock_wait_observer # Recebe o tempo (s) de espera por cada aquisição de lock
+        self._expiry_heap = []
+        self._result_owner = {} # Índice reverso result_id -> task_id
+        # Ordem dos locks: faixa -> índice de expiração (nunca o inverso)
+        self._expiry_cond = threading.Condition() # Acorda a limpeza quando surge um prazo mais próximo
+        self._cleanup_thread = None
+
+    def start(self):
+        """Inicia a thread de limpeza em background."""
+        self._cleanup_thread = threading.Thread(target=self._cleanup_loop, name="state-cleanup", daemon=True)
+        self._cleanup_thread.start()
+
+    def create_task(self, task_id, task):
+        with self._locked(task_id):
+            self.tasks[task_id] = TaskRecord(task)
+
+    def get_task(self, task_id):
+        with self._locked(task_id):
+            # Retorna uma cópia para evitar modificações externas inesperadas
+            record = self.tasks.get(task_id)
+            return record.as_dict() if record else None
+
+    def update_task(self, task_id, fields, expires_at=None):
+        with self._locked(task_id):
+            record = self.tasks.get(task_id)
+            if record is None:
+                return False
+            record.update(fields)
+            record.version += 1
+            if fields.get('result_id'):
+                self._result_owner[fields['result_id']] = task_id
+            if expires_at is not None:
+                record.expires_at = expires_at
+                self._schedule_expiry(expires_at, 'task', task_id)
+            if record.changed is not None:
+                record.changed.notify_all()
+            return True
+
+    def delete_task(self, task_id):
+        with self._locked(task_id):
+            self._remove_task(task_id)
+
+    def wait_for_task(self, task_id, version, timeout):
+        with self._locked(task_id):
+            record = self.tasks.get(task_id)
+            if record is not None and record.version == version:
+                if record.changed is None:
+                    record.changed = threading.Condition(self._stripe(task_id))
+                record.changed.wait_for(lambda: record.version != version or self.tasks.get(task_id) is not record,
+                                        timeout)
+                record = self.tasks.get(task_id)
+            return record.as_dict() if record else None
+
+    def store_result(self, result_id, result, expires_at):
+        with self._locked(result_id):
+            self.results[result_id] = dict(result, expires_at=expires_at)
+            self._schedule_expiry(expires_at, 'result', result_id)
+        for victim_id in self._account_result(result_id, self._result_size(result)):
+            logger.warning(f"Result {victim_id} removed early: result memory limit reached.")
+            self._evict_result(victim_id, early=True)
+
+    @staticmethod
+    def _result_size(result):
+        return sum(len(value) for value in result.values() if isinstance(value, (bytes, str)))
+
+    def _account_result(self, result_id, size):
+        """Contabiliza um resultado e retorna os mais antigos que devem sair para respeitar o limite."""
+        victims = []
+        with self._result_sizes_lock:
+            self._result_bytes += size - self._result_sizes.pop(result_id, 0)
+            self._result_sizes[result_id] = size
+            if self.max_result_bytes is not None:
+                total = self._result_bytes
+                for victim_id, victim_size in self._result_sizes.items():
+                    # O resultado recém-guardado fica, mesmo que sozinho passe do limite
+                    if total <= self.max_result_bytes or victim_id == result_id:
+                        break
+                    victims.append(victim_id)
+                    total -= victim_size
+        return victims
+
+    def _release_result(self, result_id):
+        """Desconta um resultado removido do total de bytes."""
+        with self._result_sizes_lock:
+            self._result_bytes -= self._result_sizes.pop(result_id, 0)
+
+    def get_result(self, result_id):
+        with self._locked(result_id):
+            result_data = self.results.get(result_id)
+            if result_data is None:
+                return None
+            if datetime.now(timezone.utc) < result_data['expires_at']:
+                # Retorna uma cópia
+                return result_data.copy()
+        # Resultado expirado (a limpeza ainda não passou por ele), remove
+        logger.info(f"Result {result_id} expired. Removing.")
+        self._evict_result(result_id, result_data['expires_at'])
+        return None
+
+    def _stripe(self, key):
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    @contextmanager
+    def _locked(self, key):
+        """Adquire o lock da faixa de 'key' medindo o tempo de espera (para as métricas de contenção).
+
+        A espera é registrada depois de liberar a faixa: o histograma tem um lock único,
+        que serializaria de novo todos os acessos se fosse tomado com a faixa adquirida.
+        """
+        lock = self._stripe(key)
+        wait_start = time.perf_counter()
+        waited = None
+        try:
+            with lock:
+                waited = time.perf_counter() - wait_start
+                yield
+        finally:
+            if self._lock_wait_observer and waited is not None:
+                self._lock_wait_observer(waited)
+
+    def _remove_task(self, task_id):
+        """Remove a tarefa e acorda quem aguarda por ela. Requer o lock da faixa."""
+        record = self.tasks.pop(task_id, None)
+        if record is not None and record.changed is not None:
+            record.changed.notify_all()
+        return record
+
+    def _schedule_expiry(self, expires_at, kind, key):
+        """Registra um prazo no índice de expiração."""
+        with self._expiry_cond:
+            heapq.heappush(self._expiry_heap, (expires_at, kind, key))
+            if self._expiry_heap[0][2] == key:
+                # Novo prazo mais próximo: acorda a thread de limpeza para recalcular a espera
+                self._expiry_cond.notify()
+
+    def _evict_result(self, result_id, expires_at=None, early=False):
+        """Remove um resultado (se ainda tiver o prazo informado, quando houver) e a tarefa associada.
+
+        Com early (limite de memória), a tarefa fica até o próprio prazo, marcada como
+        'expired', para que quem acompanha o status não receba 404.
+        """
+        with self._locked(result_id):
+            result_data = self.results.get(result_id)
+            if result_data is None or (expires_at is not None and result_data['expires_at'] != expires_at):
+                return
+            del self.results[result_id]
+        self._release_result(result_id)
+        # Remove a tarefa associada se ainda existir e não estiver processando (O(1) pelo índice reverso)
+        task_id = self._result_owner.pop(result_id, None)
+        if task_id is None:
+            return
+        with self._locked(task_id):
+            record = self.tasks.get(task_id)
+            if record is None or record.status == 'processing':
+                return
+            if early:
+                record.update({'status': 'expired', 'message': 'O resultado foi removido antes do prazo.'})
+                record.version += 1
+                if record.changed is not None:
+                    record.changed.notify_all()
+            else:
+                logger.info(f"Removing associated task {task_id} for expired result {result_id}.")
+                self._remove_task(task_id)
+
+    def _evict_task(self, task_id, expires_at):
+        """Remove uma tarefa se ela ainda tiver o prazo informado."""
+        with self._locked(task_id):
+            record = self.tasks.get(task_id)
+            # Ignora entradas obsoletas (tarefa removida ou com novo prazo)
+            if record is None or record.expires_at != expires_at:
+                return
+            logger.info(f"Cleaning up expired task status: {task_id}")
+            self._remove_task(task_id)
+        if record.result_id and self._result_owner.get(record.result_id) == task_id:
+            self._result_owner.pop(record.result_id, None)
+
+    def _pop_due_entries(self, now):
+        """Retira do heap as entradas vencidas até 'now'. Requer o lock do índice."""
+        due = []
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            due.append(heapq.heappop(self._expiry_heap))
+        return due
+
+    def _cleanup_loop(self, max_sleep_seconds=300):
+        """Remove tarefas e resultados assim que expiram, usando o índice de expiração."""
+        while True:
+            try:
+                with self._expiry_cond:
+                    due = self._pop_due_entries(datetime.now(timezone.utc))
+                # As remoções usam os locks das faixas, fora do lock do índice
+                for expires_at, kind, key in due:
+                    if kind == 'task':
+                        self._evict_task(key, expires_at)
+                    else:
+                        logger.info(f"Cleanup: Removing expired result {key}")
+                        self._evict_result(key, expires_at)
+                with self._expiry_cond:
+                    now = datetime.now(timezone.utc)
+                    # Dorme até o próximo prazo (ou até um novo prazo mais próximo ser registrado)
+                    timeout = max_sleep_seconds
+                    if self._expiry_heap:
+                        timeout = min(timeout, max(0.0, (self._expiry_heap[0][0] - now).total_seconds()))
+                    if timeout > 0:
+                        self._expiry_cond.wait(timeout)
+            except Exception as e:
+                logger.exception(f"Error during cleanup: {e}") # Log do erro
+                time.sleep(1) # Evita um loop apertado em caso de erro persistente
+
+
+def _to_timestamp(value):
+    return value.timestamp() if value is not None else None
+
+
+def _from_timestamp(value):
+    return datetime.fromtimestamp(value, timezone.utc)
+
+
+class SQLiteStateStore(StateStore):
+    """Estado num arquivo SQLite em modo WAL, compartilhado entre processos.
+
+    SQLite não tem TTL nativo: as leituras ignoram linhas vencidas, e o que
+    já expirou é apagado por uma thread de limpeza (a cada purge_interval_seconds,
+    mesmo com o servidor ocioso), nunca no caminho das requisições.
+    Com secure_delete, o conteúdo apagado é sobrescrito no arquivo, e o WAL é
+    truncado após cada limpeza para não guardar cópias antigas das páginas.
+    """
+
+    shared = True
+
+    def __init__(self, path, purge_interval_seconds=30):
+        self.path = path
+        self.purge_interval_seconds = purge_interval_seconds
+        self._local = threading.local() # Uma conexão por thread (e por processo)
+        # A conexão do esquema é fechada em seguida: uma conexão aberta antes de um
+        # fork (ex: gunicorn --preload) não pode ser usada pelo processo filho
+        conn = self._connect()
+        try:
+            self._create_schema(conn)
+        finally:
+            conn.close()
+
+    def _create_schema(self, conn):
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                status TEXT,
+                result_id TEXT,
+                data TEXT NOT NULL,
+                expires_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS tasks_expires_at ON tasks (expires_at);
+            CREATE INDEX IF NOT EXISTS tasks_result_id ON tasks (result_id);
+            CREATE TABLE IF NOT EXISTS results (
+                result_id TEXT PRIMARY KEY,
+                content BLOB NOT NULL,
+                filename TEXT,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                etag TEXT,
+                gzip BLOB,
+                br BLOB
+            );
+            CREATE INDEX IF NOT EXISTS results_expires_at ON results (expires_at);
+        """)
+        # Bancos criados por versões anteriores não têm as colunas novas
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(results)")}
+        for column, column_type in (('etag', 'TEXT'), ('gzip', 'BLOB'), ('br', 'BLOB')):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE results ADD COLUMN {column} {column_type}")
+
+    def _connect(self):
+        # isolation_level=None: transações explícitas com BEGIN IMMEDIATE
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA secure_delete=ON") # Sobrescreve o conteúdo apagado
+        return conn
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        # Após um fork, a thread que sobrevive no filho ainda enxerga a conexão do pai:
+        # ela é descartada sem ser fechada (fechá-la afetaria o pai) e o filho abre a sua
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def start(self):
+        """Inicia a thread que apaga as linhas vencidas periodicamente."""
+        self._purge_thread = threading.Thread(target=self._purge_loop, name="state-purge", daemon=True)
+        self._purge_thread.start()
+
+    def _purge_loop(self):
+        while True:
+            time.sleep(self.purge_interval_seconds)
+            try:
+                self.purge_expired()
+            except Exception as e:
+                logger.error(f"Erro ao apagar estado vencido do SQLite: {e}")
+
+    def create_task(self, task_id, task):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO tasks (task_id, status, result_id, data, expires_at) VALUES (?, ?, ?, ?, NULL)",
+            (task_id, task.get('status'), task.get('result_id'), json.dumps(dict(task, version=0))))
+
+    def get_task(self, task_id):
+        row = self._conn().execute(
+            "SELECT data FROM tasks WHERE task_id = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (task_id, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update_task(self, task_id, fields, expires_at=None):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT data FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+            if row is None:
+                conn.execute("ROLLBACK")
+                return False
+            task = json.loads(row[0])
+            task.update(fields)
+            task['version'] = task.get('version', 0) + 1
+            conn.execute(
+                "UPDATE tasks SET status = ?, result_id = ?, data = ?, expires_at = COALESCE(?, expires_at) WHERE task_id = ?",
+                (task.get('status'), task.get('result_id'), json.dumps(task), _to_timestamp(expires_at), task_id))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return True
+
+    def delete_task(self, task_id):
+        self._conn().execute("DELETE FROM tasks WHERE task_id = ?", (task_id,))
+
+    def store_result(self, result_id, result, expires_at):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO results (result_id, content, filename, created_at, expires_at, etag, gzip, br)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (result_id, result['content'], result.get('filename'), _to_timestamp(result['created_at']),
+             _to_timestamp(expires_at), result.get('etag'), result.get('gzip'), result.get('br')))
+
+    def get_result(self, result_id):
+        row = self._conn().execute(
+            "SELECT content, filename, created_at, etag, gzip, br FROM results WHERE result_id = ? AND expires_at > ?",
+            (result_id, time.time())).fetchone()
+        if row is None:
+            return None
+        content = row[0].encode('utf-8') if isinstance(row[0], str) else row[0] # Linhas antigas guardavam texto
+        result = {'content': content, 'filename': row[1], 'created_at': _from_timestamp(row[2]), 'etag': row[3]}
+        result.update((encoding, data) for encoding, data in zip(self.RESULT_ENCODINGS, row[4:]) if data is not None)
+        return result
+
+    def purge_expired(self):
+        """Apaga tarefas e resultados vencidos e trunca o WAL se algo foi apagado."""
+        now = time.time()
+        conn = self._conn()
+        changes_before = conn.total_changes
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Tarefas cujo resultado expirou saem junto com ele (exceto as que ainda processam)
+            conn.execute("""
+                DELETE FROM tasks WHERE status != 'processing' AND result_id IN
+                    (SELECT result_id FROM results WHERE expires_at <= ?)""", (now,))
+            conn.execute("DELETE FROM results WHERE expires_at <= ?", (now,))
+            conn.execute("DELETE FROM tasks WHERE expires_at <= ?", (now,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if conn.total_changes != changes_before:
+            # As páginas anteriores à exclusão também ficam no WAL até ele ser reiniciado
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+class RedisStateStore(StateStore):
+    """Estado num servidor compatível com Redis (Redis, Valkey, KeyDB...).
+
+    Os prazos viram TTLs nativos (PEXPIREAT), então não há thread de limpeza.
+    Requer o pacote 'redis'.
+    """
+
+    shared = True
+
+    # Atualiza campos apenas se a tarefa ainda existir (atômico no servidor)
+    _UPDATE_SCRIPT = """
+        if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+        redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+        redis.call('HINCRBY', KEYS[1], 'version', 1)
+        if ARGV[1] ~= '' then redis.call('PEXPIREAT', KEYS[1], ARGV[1]) end
+        return 1
+    """
+
+    def __init__(self, url, prefix='braindump'):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("O backend 'redis' requer o pacote 'redis' (pip install redis).") from e
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+        self._update = self._client.register_script(self._UPDATE_SCRIPT)
+
+    def _task_key(self, task_id):
+        return f"{self.prefix}:task:{task_id}"
+
+    def _result_key(self, result_id):
+        return f"{self.prefix}:result:{result_id}"
+
+    @staticmethod
+    def _encode(fields):
+        # Os valores são codificados em JSON para preservar None e tipos simples
+        return {name: json.dumps(value) for name, value in fields.items()}
+
+    def create_task(self, task_id, task):
+        self._client.hset(self._task_key(task_id), mapping=self._encode(dict(task, version=0)))
+
+    def get_task(self, task_id):
+        data = self._client.hgetall(self._task_key(task_id))
+        if not data:
+            return None
+        return {name.decode(): json.loads(value) for name, value in data.items()}
+
+    def update_task(self, task_id, fields, expires_at=None):
+        args = [str(int(expires_at.timestamp() * 1000)) if expires_at else '']
+        for name, value in self._encode(fields).items():
+            args.extend([name, value])
+        return bool(self._update(keys=[self._task_key(task_id)], args=args))
+
+    def delete_task(self, task_id):
+        self._client.delete(self._task_key(task_id))
+
+    def store_result(self, result_id, result, expires_at):
+        key = self._result_key(result_id)
+        pipe = self._client.pipeline()
+        mapping = {
+            'content': result['content'],
+            'filename': result.get('filename') or '',
+            'created_at': str(_to_timestamp(result['created_at'])),
+            'etag': result.get('etag') or '',
+        }
+        mapping.update((encoding, result[encoding]) for encoding in self.RESULT_ENCODINGS if result.get(encoding))
+        pipe.delete(key) # Remove variantes de uma versão anterior do resultado
+        pipe.hset(key, mapping=mapping)
+        pipe.pexpireat(key, int(expires_at.timestamp() * 1000))
+        pipe.execute()
+
+    def get_result(self, result_id):
+        data = self._client.hgetall(self._result_key(result_id))
+        if not data:
+            return None
+        result = {
+            'content': data[b'content'],
+            'filename': data[b'filename'].decode('utf-8') or None,
+            'created_at': _from_timestamp(float(data[b'created_at'])),
+            'etag': data.get(b'etag', b'').decode('utf-8') or None,
+        }
+        result.update((encoding, data[encoding.encode()]) for encoding in self.RESULT_ENCODINGS
+                      if encoding.encode() in data)
+        return result
+
+
+def create_state_store(backend, sqlite_path=None, redis_url=None, lock_wait_observer=None, max_result_bytes=None):
+    """Cria o backend de estado configurado ('memory', 'sqlite' ou 'redis').
+
+    max_result_bytes limita a memória dos resultados no backend em memória.
+    """
+    if backend == 'memory':
+        return MemoryStateStore(lock_wait_observer=lock_wait_observer, max_result_bytes=max_result_bytes)
+    if backend == 'sqlite':
+        return SQLiteStateStore(sqlite_path)
+    if backend == 'redis':
+        return RedisStateStore(redis_url)
+    raise ValueError(f"Backend de estado desconhecido: {backend}")
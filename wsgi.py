@@ -1,7 +1,3 @@
-# Importa a instância 'app' do seu arquivo principal (app.py)
-# A variável DEVE se chamar 'application' para o PythonAnywhere encontrar
-from app import app as application
-
 import sys
 import os
 
@@ -10,6 +6,8 @@ path = '/home/joaomj/braindump_app'
 if path not in sys.path:
     sys.path.insert(0, path)
 
-# Importa a instância 'app' do seu arquivo principal (app.py)
+# Cria o app a partir do arquivo principal (app.py); as threads de fundo sobem
+# na primeira requisição de cada worker
 # A variável DEVE se chamar 'application' para o PythonAnywhere encontrar
-from app import app as application
\ No newline at end of file
+from app import create_app
+application = create_app()
\ No newline at end of file